@@ -0,0 +1,257 @@
+"""
+Running subprocess based (isolated and MPI) tests from a single process using asyncio.
+
+Normally each isolated or MPI test ties up a whole worker process that does
+nothing but wait for its subprocess to finish.  The AsyncSubprocRunner launches
+those subprocesses itself and waits for all of them at once, so no intermediate
+worker processes are needed.  Any test groups that must run in-process are
+handed to a wrapped TestRunner, which runs in a separate thread.
+"""
+
+import os
+import queue
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+from testflo.runner import TestRunner, ABORT, ABORT_MSG, _is_failure
+from testflo.qman import get_result_file, remove_result_file
+from testflo.util import kill_process_tree
+
+_DONE = object()
+_WAKE = object()
+
+
+def _task_done(done):
+    """Return a callback that puts the result of a finished task on the done queue."""
+    def callback(task):
+        if not task.cancelled():
+            done.put_nowait((task, task.result()))
+    return callback
+
+
+class AsyncSubprocRunner(TestRunner):
+    """
+    Runs isolated and MPI tests in subprocesses started directly with asyncio.
+
+    Each subprocess takes core slots from slot_budget, N_PROCS for each MPI test and
+    one for each isolated test.  The wrapped runner takes its slots from the same
+    budget, so together they never use more than --core-slots.
+
+    Attributes
+    ----------
+    inner : TestRunner
+        Runner used for test groups that don't run entirely in subprocesses.
+    slot_budget : SlotBudget
+        Core slots shared with the wrapped runner.
+    """
+
+    def __init__(self, options, inner, slot_budget):
+        super(AsyncSubprocRunner, self).__init__(options, None)
+        self.options = options
+        self.inner = inner
+        # share the rerun count and time budget with the wrapped runner
+        self.reruns = inner.reruns
+        self.slot_budget = slot_budget
+        self._stopping = False
+        self._aborting = False
+
+    def get_iter(self, input_iter):
+        loop = asyncio.new_event_loop()
+        agen = self._run(input_iter)
+        try:
+            while True:
+                try:
+                    results = loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+                for result in results:
+                    yield result
+                    if self.stop and _is_failure(result):
+                        # let running tests finish, but don't start any more
+                        self._stopping = True
+                        self._aborting = self.options.fast_abort
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
+
+    def _slots(self, test):
+        return min(test.nprocs if test.subproc_kind() == 'mpi' else 1,
+                   self.slot_budget.total)
+
+    def _start_inner(self, loop, done):
+        """Start the wrapped runner in a thread and return the queue that feeds it."""
+        inner_q = queue.Queue()
+
+        def run_inner():
+            try:
+                for result in self.inner.get_iter(iter(inner_q.get, _DONE)):
+                    loop.call_soon_threadsafe(done.put_nowait, (None, result))
+            finally:
+                loop.call_soon_threadsafe(done.put_nowait, (None, _DONE))
+
+        threading.Thread(target=run_inner, daemon=True).start()
+        return inner_q
+
+    async def _run(self, input_iter):
+        loop = asyncio.get_running_loop()
+        done = asyncio.Queue()
+        source = iter(input_iter)
+        waiting = deque()   # tests waiting for free slots
+        inner_q = None
+        inner_running = False
+        exhausted = False
+        tasks = set()
+
+        def wake():
+            # the wrapped runner freed some slots
+            loop.call_soon_threadsafe(done.put_nowait, (None, _WAKE))
+
+        self.slot_budget.add_listener(wake)
+        try:
+            while True:
+                # start as many subprocesses as we have slots for
+                while not self._stopping:
+                    if not waiting:
+                        if exhausted:
+                            break
+                        tests = next(source, None)
+                        if tests is None:
+                            exhausted = True
+                            break
+                        tests = list(tests)
+                        if all(t.subproc_kind() for t in tests):
+                            waiting.extend(tests)
+                        else:
+                            # the group has to run in-process, e.g., to share fixtures
+                            if inner_q is None:
+                                inner_q = self._start_inner(loop, done)
+                                inner_running = True
+                            inner_q.put(tests)
+                        continue
+
+                    # the oldest waiting test goes first so big MPI tests can't starve
+                    slots = self._slots(waiting[0])
+                    if not self.slot_budget.take(slots):
+                        break
+                    test = waiting.popleft()
+                    task = loop.create_task(self._run_test(test))
+                    task.test = test
+                    task.slots = slots
+                    tasks.add(task)
+                    task.add_done_callback(_task_done(done))
+
+                if exhausted or self._stopping:
+                    if inner_q is not None:
+                        inner_q.put(_DONE)
+                        inner_q = None
+
+                if not tasks and not inner_running and (self._stopping or
+                                                        (exhausted and not waiting)):
+                    if self._stopping:
+                        # reruns that won't happen now still have to report their
+                        # failures
+                        failed = [self.reruns.abandon(test) for test in waiting]
+                        yield [result for result in failed if result is not None]
+                    break
+
+                task, result = await done.get()
+                if result is _WAKE:
+                    continue
+                if result is _DONE:
+                    inner_running = False
+                    continue
+                if task is not None:
+                    tasks.discard(task)
+                    self.slot_budget.release(task.slots)
+                    again = self.reruns.rerun(result)
+                    if again is not None:
+                        # rerun it before any other waiting tests
+                        waiting.appendleft(again)
+                        continue
+                    result = self.reruns.finish(result)
+                yield [result]
+
+                if self._aborting and tasks:
+                    aborted = await self._abort(tasks)
+                    self.slot_budget.release(sum(task.slots for task in aborted))
+                    results = []
+                    for task in aborted:
+                        failed = self.reruns.abandon(task.test)
+                        results.append(task.test if failed is None else failed)
+                    yield results
+        finally:
+            self.slot_budget.remove_listener(wake)
+            if inner_q is not None:
+                inner_q.put(_DONE)
+            for task in tasks:
+                task.cancel()
+                self.slot_budget.release(task.slots)
+
+    async def _abort(self, tasks):
+        """Cancel the given running tasks, which kills their subprocesses, and return
+        the ones that were cancelled with their tests marked as aborted.
+        """
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # a task that finished just before we cancelled it still has its result queued
+        aborted = [task for task in tasks if task.cancelled()]
+        for task in aborted:
+            tasks.discard(task)
+            task.test.status = ABORT
+            task.test.err_msg = ABORT_MSG
+        return aborted
+
+    async def _run_test(self, test):
+        """Run the given test in a subprocess and return the result."""
+        kind = test.subproc_kind()
+        result_file = get_result_file()
+        try:
+            cmd = test._mpi_cmd() if kind == 'mpi' else test._isolated_cmd()
+
+            if self.options.nocapture:
+                stdout = asyncio.subprocess.PIPE
+                stderr = asyncio.subprocess.STDOUT
+            else:
+                stdout = asyncio.subprocess.DEVNULL
+                stderr = asyncio.subprocess.PIPE
+
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=stdout, stderr=stderr,
+                env=test._subproc_env(os.environ, result_file))
+
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), self.options.timeout)
+            except asyncio.TimeoutError:
+                # mpirun's ranks have to go too
+                kill_process_tree(proc.pid)
+                await proc.wait()
+                test.status = 'FAIL'
+                test.err_msg = "Test timed out after %s seconds." % self.options.timeout
+                result = test
+            except asyncio.CancelledError:
+                kill_process_tree(proc.pid)
+                await proc.wait()
+                raise
+            else:
+                out = out if self.options.nocapture else err
+                result = test._subproc_result(proc.returncode,
+                                              out.decode(errors='replace'),
+                                              result_file)
+        except Exception:
+            test.status = 'FAIL'
+            test.err_msg = traceback.format_exc()
+            result = test
+        finally:
+            remove_result_file(result_file)
+
+        for r in result:
+            if kind == 'mpi':
+                r.mpi = True
+            else:
+                r.isolated = True
+
+        return result
@@ -0,0 +1,454 @@
+"""
+Persistent caches kept between testflo runs.
+"""
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import functools
+import sysconfig
+from collections import OrderedDict
+
+import testflo
+from testflo.util import get_testpath
+
+
+def file_hash(fname):
+    """Return the sha1 hex digest of the contents of the given file."""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_pickle(fname, version):
+    """Return the data stored in the given pickle file if it exists and was written by
+    the current testflo version using the given format version, else None.
+    """
+    try:
+        with open(fname, 'rb') as f:
+            header, data = pickle.load(f)
+    except Exception:
+        return None
+
+    if header != (testflo.__version__, version):
+        return None
+
+    return data
+
+
+def _write_pickle(fname, version, data):
+    """Atomically write the given data to a pickle file."""
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(((testflo.__version__, version), data), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+
+
+def _read_json(fname, version):
+    """Return the data stored in the given JSON file, which must have been written using
+    the given format version by any testflo version.
+
+    Raises OSError if the file can't be read or ValueError if it can't be used.
+    """
+    with open(fname) as f:
+        contents = json.load(f)
+
+    if not isinstance(contents, dict) or 'data' not in contents:
+        raise ValueError("not a testflo data file")
+    if contents.get('format') != version:
+        raise ValueError("written in format %s by testflo %s, but format %s is needed" %
+                         (contents.get('format'), contents.get('testflo'), version))
+
+    return contents['data']
+
+
+def _write_json(fname, version, data):
+    """Atomically write the given data to a JSON file."""
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'testflo': testflo.__version__, 'format': version, 'data': data}, f,
+                  indent=0, sort_keys=True)
+    os.replace(tmp, fname)
+
+
+def _discovery_env():
+    """Return a description of the python environment that discovered tests depend on:
+    the interpreter and the modification times of the site-packages directories, which
+    change when packages are installed or removed.
+    """
+    sites = []
+    for name in ('purelib', 'platlib'):
+        path = sysconfig.get_path(name)
+        try:
+            sites.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            sites.append((path, None))
+    return (sys.executable, sys.version, tuple(sorted(set(sites))))
+
+
+class DiscoveryCache(object):
+    """
+    Stores the ModuleInfo for each test file found during discovery so that
+    unchanged files don't have to be imported or parsed again on the next run.
+
+    An entry is invalidated when the mtime or size of its file, or of any file
+    defining a base class of one of its TestCases, changes.  For modules that had to
+    be imported, that includes every file imported along with the module, other than
+    the standard library and site-packages.  The whole cache is invalidated when the
+    python interpreter changes or packages are installed into or removed from
+    site-packages.  If use_hash is True, a file whose mtime or size changed but whose
+    contents did not is still considered valid.
+
+    Tests defined based on environment variables or anything else that isn't a
+    python file aren't noticed, so don't use the cache for modules like that.
+
+    Attributes
+    ----------
+    fname : str
+        Name of the file where the cache is stored.
+    use_hash : bool
+        If True, check content hashes of files whose mtime or size changed.
+    """
+
+    _version = 2
+
+    def __init__(self, cache_dir, use_hash=False):
+        self.fname = os.path.join(cache_dir, 'discovery.pkl')
+        self.use_hash = use_hash
+        self._env = _discovery_env()
+        data = _read_pickle(self.fname, self._version)
+        if data is None or data['env'] != self._env:
+            data = {'env': self._env, 'entries': {}}
+        self._entries = data['entries']
+        self._stamps = {}
+        self._dirty = False
+
+    def _stamp(self, fname):
+        """Return a tuple of the form (mtime, size, hash) for the given file."""
+        stamp = self._stamps.get(fname)
+        if stamp is None:
+            st = os.stat(fname)
+            stamp = self._stamps[fname] = (st.st_mtime_ns, st.st_size, None)
+        return stamp
+
+    def _is_current(self, fname, old):
+        """Return True if the given file still matches the stamp it had when cached."""
+        try:
+            stamp = self._stamp(fname)
+        except OSError:
+            return False
+
+        if stamp[:2] == old[:2]:
+            return True
+
+        if self.use_hash and old[2] is not None and stamp[1] == old[1]:
+            if stamp[2] is None:
+                stamp = self._stamps[fname] = stamp[:2] + (file_hash(fname),)
+            return stamp[2] == old[2]
+
+        return False
+
+    def get(self, fname, modpath):
+        """Return the cached ModuleInfo for the given file, or None if it's missing or
+        out of date.
+        """
+        fname = os.path.abspath(fname)
+        entry = self._entries.get(fname)
+        if entry is None:
+            return None
+
+        stamps, info = entry
+        if info.modpath != modpath:
+            return None
+
+        for dep, stamp in stamps:
+            if not self._is_current(dep, stamp):
+                del self._entries[fname]
+                self._dirty = True
+                return None
+
+        if self.use_hash and any(self._stamps[dep][:2] != stamp[:2] for dep, stamp in stamps):
+            # contents are unchanged, so just update the timestamps
+            self.put(fname, info)
+
+        return info
+
+    def put(self, fname, info):
+        """Add the ModuleInfo for the given file to the cache."""
+        fname = os.path.abspath(fname)
+        stamps = []
+        try:
+            for dep in (fname,) + info.deps:
+                stamp = self._stamp(dep)
+                if self.use_hash and stamp[2] is None:
+                    stamp = self._stamps[dep] = stamp[:2] + (file_hash(dep),)
+                stamps.append((dep, stamp))
+        except OSError:
+            return
+
+        self._entries[fname] = (stamps, info)
+        self._dirty = True
+
+    def save(self):
+        """Write the cache to disk if anything has changed."""
+        if self._dirty:
+            _write_pickle(self.fname, self._version,
+                          {'env': self._env, 'entries': self._entries})
+            self._dirty = False
+
+
+class DurationCache(object):
+    """
+    Stores the duration of each test from previous runs, keyed by test spec with the
+    real path of its file, so that a test's duration is found no matter which directory
+    testflo is run from or how the test is specified.
+
+    The durations are stored as JSON rather than pickled, because the file may be shared
+    between machines for --shard-durations, and loading a pickle can run arbitrary code.
+
+    Attributes
+    ----------
+    fname : str
+        Name of the file where the durations are stored.
+    error : str or None
+        Why the durations file couldn't be used, if it couldn't.
+    """
+
+    _version = 2
+
+    def __init__(self, cache_dir, fname=None):
+        self.fname = fname or os.path.join(cache_dir, 'durations.json')
+        self.error = None
+        try:
+            durations = _read_json(self.fname, self._version)
+            if not (isinstance(durations, dict) and
+                    all(isinstance(d, (int, float)) for d in durations.values())):
+                raise ValueError("the durations aren't a mapping of test to seconds")
+        except (OSError, ValueError) as err:
+            self.error = str(err)
+            durations = {}
+        self._durations = durations
+        self._default = None
+        self._dirty = False
+
+    def __contains__(self, spec):
+        return spec_key(spec) in self._durations
+
+    def __len__(self):
+        return len(self._durations)
+
+    def items(self):
+        """Return the (spec, duration) pairs of all recorded tests."""
+        return self._durations.items()
+
+    def estimate(self, spec):
+        """Return the expected duration of the given test.
+
+        Tests without a recorded duration are assumed to take the mean duration of
+        all recorded tests.
+        """
+        try:
+            return self._durations[spec_key(spec)]
+        except KeyError:
+            if self._default is None:
+                if self._durations:
+                    self._default = sum(self._durations.values()) / len(self._durations)
+                else:
+                    self._default = 0.
+            return self._default
+
+    def update(self, spec, duration):
+        """Record the duration of a test run."""
+        spec = spec_key(spec)
+        old = self._durations.get(spec)
+        if old is not None:
+            # smooth out noise from one run to the next
+            duration = 0.5 * (old + duration)
+        self._durations[spec] = duration
+        self._dirty = True
+
+    def save(self):
+        """Write the durations to disk if anything has changed."""
+        if self._dirty:
+            _write_json(self.fname, self._version, self._durations)
+            self._dirty = False
+
+
+# many tests share the same file, so don't look up the same path over and over
+_realpath = functools.lru_cache(maxsize=4096)(os.path.realpath)
+
+
+def spec_key(spec):
+    """Return the given test spec with the real path of its file, so that it doesn't depend
+    on the directory that testflo was run from.
+    """
+    testpath, rest = get_testpath(spec)
+    testpath = _realpath(testpath)
+    return ':'.join((testpath, rest)) if rest else testpath
+
+
+class TestDependencyMap(object):
+    """
+    Stores the source files executed by each test, keyed by test spec, as recorded by
+    coverage using --cover-contexts.
+
+    Attributes
+    ----------
+    fname : str
+        Name of the file where the dependencies are stored.
+    """
+
+    _version = 1
+
+    def __init__(self, cache_dir):
+        self.fname = os.path.join(cache_dir, 'test_deps.pkl')
+        self._deps = _read_pickle(self.fname, self._version) or {}
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._deps)
+
+    def update(self, deps):
+        """Replace the dependencies of the tests in the given dict of spec to files."""
+        for spec, files in deps.items():
+            # many tests share the same files, so share the strings too
+            self._deps[spec_key(spec)] = frozenset(sys.intern(f) for f in files)
+        if deps:
+            self._dirty = True
+
+    def is_affected(self, spec, changed):
+        """Return True if the given test may be affected by the given set of changed files
+        (real paths), i.e., if the test's own file changed, no dependencies were recorded
+        for the test, or any of its dependencies changed.
+        """
+        files = self._deps.get(spec_key(spec))
+        if files is None:
+            return True
+        testpath, _ = get_testpath(spec)
+        return os.path.realpath(testpath) in changed or not changed.isdisjoint(files)
+
+    def save(self):
+        """Write the dependencies to disk if anything has changed."""
+        if self._dirty:
+            _write_pickle(self.fname, self._version, self._deps)
+            self._dirty = False
+
+
+class ResultCache(object):
+    """
+    Stores the source files used by each test that passed, along with a digest of
+    their contents, so that the test can be skipped in later runs until one of
+    those files changes.
+
+    File contents are only rehashed when a file's mtime or size changes.  Entries are
+    kept in least recently used order, and the oldest are dropped when there are more
+    than max_entries.
+
+    Attributes
+    ----------
+    fname : str
+        Name of the file where the results are stored.
+    max_entries : int
+        Maximum number of test results to keep.
+    """
+
+    _version = 1
+
+    def __init__(self, cache_dir, max_entries=10000):
+        self.fname = os.path.join(cache_dir, 'results.pkl')
+        self.max_entries = max_entries
+
+        # results depend on the interpreter as well as the source
+        self._env = (sys.executable, sys.version)
+
+        data = _read_pickle(self.fname, self._version)
+        if data is None or data['env'] != self._env:
+            data = {'env': self._env, 'entries': OrderedDict(), 'files': {}}
+        self._entries = data['entries']  # spec key -> (paths, digest)
+        self._files = data['files']  # path -> (mtime, size, sha1)
+
+        self._hashes = {}  # hashes of files already checked in this run
+        self._dirty = False
+
+    def _file_hash(self, path):
+        """Return the sha1 hex digest of the given file, or '' if it doesn't exist."""
+        h = self._hashes.get(path)
+        if h is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                h = ''
+            else:
+                old = self._files.get(path)
+                if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+                    h = old[2]
+                else:
+                    h = file_hash(path)
+                    self._files[path] = (st.st_mtime_ns, st.st_size, h)
+                    self._dirty = True
+            self._hashes[path] = h
+        return h
+
+    def _digest(self, paths):
+        """Return a digest of the names and contents of the given files."""
+        h = hashlib.sha1()
+        for path in sorted(paths):
+            h.update(("%s\0%s\n" % (path, self._file_hash(path))).encode('utf-8',
+                                                                          'surrogateescape'))
+        return h.hexdigest()
+
+    def is_current(self, spec):
+        """Return True if the given test passed before and none of the files it used
+        have changed since.
+        """
+        key = spec_key(spec)
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+
+        paths, digest = entry
+        if self._digest(paths) != digest:
+            return False
+
+        self._entries.move_to_end(key)
+        self._dirty = True
+        return True
+
+    def put(self, spec, deps):
+        """Record that the given test passed using the given source files."""
+        testpath, _ = get_testpath(spec)
+        paths = frozenset((sys.intern(os.path.realpath(testpath)),) + tuple(deps))
+        key = spec_key(spec)
+        self._entries[key] = (paths, self._digest(paths))
+        self._entries.move_to_end(key)
+        self._dirty = True
+
+    def remove(self, spec):
+        """Forget any earlier result of the given test."""
+        if self._entries.pop(spec_key(spec), None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """Write the cache to disk if anything has changed, dropping the least recently
+        used results if there are too many.
+        """
+        if not self._dirty:
+            return
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        used = set()
+        for paths, _ in self._entries.values():
+            used.update(paths)
+        files = {path: stamp for path, stamp in self._files.items() if path in used}
+
+        _write_pickle(self.fname, self._version,
+                      {'env': self._env, 'entries': self._entries, 'files': files})
+        self._dirty = False
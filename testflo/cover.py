@@ -102,4 +102,20 @@ def finalize_coverage(options, cov):
 
         print(f"\nHTML report generated at: {index_file}")
 
-    return cov
\ No newline at end of file
+    return cov
+
+
+def get_test_dependencies(cov):
+    """
+    Returns a dict mapping the spec of each test recorded in the dynamic contexts of
+    the given (combined) coverage data to the set of measured files it executed.
+    """
+    data = cov.get_data()
+    deps = {}
+    for fname in data.measured_files():
+        path = os.path.realpath(fname)
+        for contexts in data.contexts_by_lineno(fname).values():
+            for context in contexts:
+                if context:  # lines run outside of any test have an empty context
+                    deps.setdefault(context, set()).add(path)
+    return deps
@@ -18,7 +18,7 @@ class DeprecationsReport(object):
 
         for tests in input_iter:
             for test in tests:
-                for msg, locs in test.deprecations.items():
+                for msg, locs in (test.deprecations or {}).items():
                     deprecations[msg] = deprecations.get(msg, set()) | locs
                 yield test
 
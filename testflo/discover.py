@@ -1,23 +1,31 @@
 
+import os
+import sys
 import traceback
-from inspect import getmembers, isclass, isfunction
+from inspect import getmembers
 from importlib import import_module
 from unittest import TestCase
 from fnmatch import fnmatchcase
 
 from os.path import basename, dirname, isdir
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
 
-from testflo.util import find_files, get_module, get_testpath, ismethod
+from testflo.util import find_files, get_module, get_modpath, get_testpath, ismethod
 from testflo.test import Test
+from testflo.modinfo import get_module_info, parse_module_info, _has_class_fixture
+from testflo.cache import DiscoveryCache
+from testflo.sourcedeps import imported_files
 
-def _has_class_fixture(tcase):
-    if tcase is not None:
-        for klass in tcase.__mro__:
-            if klass is TestCase:
-                break
-            if 'setUpClass' in klass.__dict__ or 'tearDownClass' in klass.__dict__:
-                return  True
-    return False
+
+class _ModuleDone(object):
+    """Marks the point in the discovery iterator where all of the tests
+    in a module have been found.
+    """
+
+    def __init__(self, modpath, tcasenames):
+        self.modpath = modpath
+        self.tcasenames = tcasenames
 
 
 class TestDiscoverer(object):
@@ -37,31 +45,71 @@ class TestDiscoverer(object):
         self._mod_fixture_groups = {}
         self._tcase_fixture_groups = {}
 
+        # whether or not a given module or (module, TestCase) has fixtures.
+        self._mod_fixtures = {}
+        self._tcase_fixtures = {}
+
+        if options.discovery_cache:
+            self._cache = DiscoveryCache(options.cache_dir, options.cache_hash)
+        else:
+            self._cache = None
+
+        # worker processes used to import test modules during discovery
+        self._pool = None
+
     def get_iter(self, input_iter):
         """Returns an iterator of Test objects
         based on the starting list of directories/modules/testspecs.
         """
         seen = set()
-        for tests in input_iter:
-            if isdir(tests):
-                itr = self._dir_iter
-            else:
-                itr = self._testspec_iter
+        try:
+            for tests in input_iter:
+                if isdir(tests):
+                    itr = self._dir_iter
+                else:
+                    itr = self._testspec_iter
+
+                for result in itr(tests):
+                    if isinstance(result, _ModuleDone):
+                        # all tests in the module have been found, so its fixture
+                        # groups are complete and can be run right away.
+                        for group in self._pop_groups([result.modpath],
+                                                      [(result.modpath, n)
+                                                       for n in result.tcasenames]):
+                            yield group
+                    elif result.spec not in seen:
+                        seen.add(result.spec)
+                        result = self._filter(result)
+                        if result is not None:
+                            yield result
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
 
-            for result in itr(tests):
-                if result.spec not in seen:
-                    seen.add(result.spec)
-                    result = self._filter(result)
-                    if result is not None:
-                        yield result
+        if self._cache is not None:
+            self._cache.save()
 
         # Every test left has been group together either by module or
         # TestCase or both, due to the presence of module or testcase class level
         # setup/teardown, and we need to run each group on the same
         # process so that we can execute the module or class level setup/teardown
         # only once while impacting all of the tests in that group.
+        for group in self._pop_groups(list(self._mod_fixture_groups),
+                                      list(self._tcase_fixture_groups)):
+            yield group
+
+    def _pop_groups(self, mod_keys, tcase_keys):
+        """Removes the given module and TestCase fixture groups from those being
+        collected and returns an iterator over them, with their first and last tests
+        marked.
+        """
         new_tcase_groups = []
-        for tests in self._tcase_fixture_groups.values():
+        for key in tcase_keys:
+            tests = self._tcase_fixture_groups.pop(key, None)
+            if tests is None:
+                continue
+
             tests = sorted(tests, key=lambda t: t.spec)
 
             # mark the first and last tests so that we know when to
@@ -78,7 +126,11 @@ class TestDiscoverer(object):
             new_tcase_groups.append(tests)
 
         # yield any tests that are grouped because of a module level fixture.
-        for tests in self._mod_fixture_groups.values():
+        for key in mod_keys:
+            tests = self._mod_fixture_groups.pop(key, None)
+            if tests is None:
+                continue
+
             tests = sorted(tests, key=lambda t: t.spec)
 
             # mark the first and last tests so that we know when to
@@ -100,17 +152,23 @@ class TestDiscoverer(object):
         if test.status is not None:
             return test
 
-        mod = import_module(test.modpath)
+        full_tcase = (test.modpath, test.tcasename)
+        if full_tcase not in self._tcase_fixtures:
+            # this test didn't come from a ModuleInfo, so we have to import its module
+            mod = import_module(test.modpath)
+            self._mod_fixtures[test.modpath] = (hasattr(mod, 'setUpModule') or
+                                                hasattr(mod, 'tearDownModule'))
+            testcase = getattr(mod, test.tcasename) if test.tcasename else None
+            self._tcase_fixtures[full_tcase] = _has_class_fixture(testcase)
+
         if test.modpath in self._mod_fixture_groups:
             self._mod_fixture_groups[test.modpath].append(test)
-        elif hasattr(mod, 'setUpModule') or hasattr(mod, 'tearDownModule'):
+        elif self._mod_fixtures[test.modpath]:
             self._mod_fixture_groups[test.modpath] = [test]
 
-        full_tcase = (test.modpath, test.tcasename)
-        testcase = getattr(mod, test.tcasename) if test.tcasename else None
         if full_tcase in self._tcase_fixture_groups:
             self._tcase_fixture_groups[full_tcase].append(test)
-        elif _has_class_fixture(testcase):
+        elif self._tcase_fixtures[full_tcase]:
             self._tcase_fixture_groups[full_tcase] = [test]
 
         if not (test.modpath in self._mod_fixture_groups or
@@ -122,35 +180,127 @@ class TestDiscoverer(object):
         directory and its subdirectories. Returns an iterator
         of Test objects.
         """
-        for f in find_files(dname, match=self.module_pattern, direxclude=self.dir_exclude):
-            if not basename(f).startswith('__init__.'):
-                for result in self._module_iter(f):
-                    yield result
+        files = [f for f in find_files(dname, match=self.module_pattern,
+                                       direxclude=self.dir_exclude)
+                 if not basename(f).startswith('__init__.')]
+        for result in self._modules_iter(files):
+            yield result
 
     def _module_iter(self, filename):
         """Returns an iterator of Test objects for the contents of
         the given python module file.
         """
+        for result in self._modules_iter([filename]):
+            yield result
 
-        try:
-            fname, mod = get_module(filename)
-        except:
-            t =  Test(filename, self.options)
-            t.status = 'FAIL'
-            t.err_msg=traceback.format_exc()
-            yield t
-        else:
-            if basename(fname).startswith('__init__.'):
+    def _modules_iter(self, filenames):
+        """Returns an iterator of Test objects for the contents of
+        the given python module files.
+        """
+        for filename, fname, info, err_msg in self._module_infos(filenames):
+            if err_msg:
+                t =  Test(filename, self.options)
+                t.status = 'FAIL'
+                t.err_msg = err_msg
+                yield t
+            elif info is None:  # it's a package
                 for result in self._dir_iter(dirname(fname)):
                     yield result
             else:
-                for name, obj in getmembers(mod):
-                    if isclass(obj) and issubclass(obj, TestCase):
-                        for result in self._testcase_iter(filename, obj):
-                            yield result
+                for result in self._info_iter(filename, info):
+                    yield result
+                yield _ModuleDone(info.modpath, info.tcases)
 
-                    elif isfunction(obj) and self.func_match(name):
-                        yield Test(':'.join((filename, obj.__name__)), self.options)
+    def _module_infos(self, filenames):
+        """Returns an iterator of tuples of the form (filename, fname, ModuleInfo, err_msg)
+        for the given module files or module paths, in the same order.
+
+        Modules that have to be imported in order to find their tests are imported in a
+        pool of worker processes if options.discovery_procs > 1.
+        """
+        infos = []
+        for filename in filenames:
+            try:
+                fname, info = self._find_module_info(filename)
+            except:
+                infos.append((filename, filename, None, traceback.format_exc()))
+                continue
+
+            if info is None and not basename(fname).startswith('__init__.'):
+                if self._pool is None and len(filenames) > 1 and self.options.discovery_procs > 1:
+                    self._pool = Pool(self.options.discovery_procs)
+                if self._pool is not None:
+                    info = self._pool.apply_async(_import_module_info,
+                                                  (filename, self._cache is not None))
+
+            infos.append((filename, fname, info, None))
+
+        for filename, fname, info, err_msg in infos:
+            if isinstance(info, AsyncResult):
+                fname, info, err_msg = info.get()
+            elif info is None and not err_msg and not basename(fname).startswith('__init__.'):
+                fname, info, err_msg = _import_module_info(filename,
+                                                           self._cache is not None)
+            else:
+                yield filename, fname, info, err_msg
+                continue
+
+            if info is not None and self._cache is not None:
+                self._cache.put(fname, info)
+
+            yield filename, fname, info, err_msg
+
+    def _find_module_info(self, filename):
+        """Returns a tuple of the form (filename, ModuleInfo) if the tests in the given
+        module can be found without importing it, either from the discovery cache or
+        by parsing it. Otherwise ModuleInfo will be None.
+        """
+        fname, modpath = get_modpath(filename)
+        if basename(fname).startswith('__init__.'):
+            return fname, None
+
+        info = None
+        if self._cache is not None:
+            info = self._cache.get(fname, modpath)
+
+        if info is None and self.options.static_discovery:
+            info = parse_module_info(fname, modpath, self.func_match)
+            if info is not None and self._cache is not None:
+                self._cache.put(fname, info)
+
+        if info is not None and any(self.func_match(n) for n in info.unknowns):
+            # something we couldn't resolve statically might be a test function
+            info = None
+
+        return fname, info
+
+    def _info_iter(self, fname, info, tcasename=None, method=None):
+        """Returns an iterator of Test objects for the tests described by the
+        given ModuleInfo, optionally limited to a single TestCase or TestCase method.
+        """
+        modpath = info.modpath
+        self._mod_fixtures[modpath] = info.mod_fixture
+        self._tcase_fixtures[(modpath, None)] = False
+
+        members = [(n, n) for n in info.tcases]
+        if tcasename is None:
+            members.extend(info.funcs)
+
+        for name, realname in sorted(members):
+            if name in info.tcases:
+                if tcasename is not None and name != tcasename:
+                    continue
+                fixture, nprocs, isolated, methods = info.tcases[name]
+                self._tcase_fixtures[(modpath, name)] = fixture
+                tcname = ':'.join((fname, name))
+                for meth in methods:
+                    if (method is None and self.func_match(meth)) or meth == method:
+                        yield Test('.'.join((tcname, meth)), self.options,
+                                   info=(modpath, name, meth, nprocs, isolated))
+
+            elif self.func_match(name):
+                yield Test(':'.join((fname, realname)), self.options,
+                           info=(modpath, None, realname, 0, False))
 
     def _testcase_iter(self, fname, testcase):
         """Returns an iterator of Test objects coming from a given
@@ -161,6 +311,18 @@ class TestDiscoverer(object):
             if self.func_match(name):
                 yield Test('.'.join((tcname, name)), self.options)
 
+    def _static_tcase_info(self, module, tcasename):
+        """Returns the ModuleInfo for the given module if it can be found without
+        importing it and it contains the named TestCase, else None.
+        """
+        try:
+            _, info = self._find_module_info(module)
+        except Exception:
+            return None  # let the import based discovery report the error
+
+        if info is not None and tcasename in info.tcases:
+            return info
+
     def _testspec_iter(self, testspec):
         """Returns an iterator of Test objects found in the
         module/testcase/method specified in testspec.  The format of
@@ -177,6 +339,12 @@ class TestDiscoverer(object):
         module, rest = get_testpath(testspec)
         if rest:
             tcasename, _, method = rest.partition('.')
+            info = self._static_tcase_info(module, tcasename)
+            if info is not None and (not method or method in info.tcases[tcasename][3]):
+                for test in self._info_iter(module, info, tcasename, method):
+                    yield test
+                return
+
             if method:
                 yield Test(testspec, self.options)
             else:  # could be a test function or a TestCase
@@ -202,6 +370,31 @@ class TestDiscoverer(object):
                 yield test
 
 
+def _import_module_info(filename, find_deps=False):
+    """Import the given module file or module path and return a tuple of the form
+    (filename, ModuleInfo, err_msg).  ModuleInfo will be None for a package.
+
+    If find_deps is True, the deps of the ModuleInfo include every file that the
+    module imported, as the discovery cache needs.
+
+    This may be run in a discovery worker process.
+    """
+    try:
+        before = set(sys.modules)
+        fname, mod = get_module(filename)
+        if basename(fname).startswith('__init__.'):
+            return fname, None, None
+        info = get_module_info(mod)
+        if find_deps:
+            # the tests found may depend on anything the module imported, so the
+            # discovery cache has to check all of those files
+            info.deps = tuple(sorted(imported_files(mod, before).union(
+                os.path.realpath(d) for d in info.deps)))
+        return fname, info, None
+    except:
+        return filename, None, traceback.format_exc()
+
+
 def get_testcase(filename, mod, tcasename):
     """Given a module and the name of a TestCase
     class, return a TestCase class object or raise an exception.
@@ -0,0 +1,502 @@
+"""
+Running tests on remote machines.
+
+A testflo run started with --serve acts as a coordinator.  Instead of starting
+local worker processes, it listens for connections from testflo-agent processes,
+which may be running on other machines.  Each agent runs the batches of test
+groups it is given using the same worker loop as a local worker process and sends
+the results back, so the rest of the pipeline (printing, summaries, FailFilter,
+etc.) works the same as in a local run.
+
+Agents import the tests using the file paths found on the coordinator, so those
+paths must be valid on every agent machine, e.g., by using a shared file system
+or an identical checkout location.
+"""
+
+import os
+import sys
+import time
+import socket
+import secrets
+import tempfile
+import threading
+from collections import deque
+from argparse import ArgumentParser
+from multiprocessing import Process, Pipe, ProcessError
+from multiprocessing.connection import (Listener, Client, wait, deliver_challenge,
+                                        answer_challenge)
+
+from testflo.runner import TestRunner, worker, merge_results, _is_failure
+from testflo.util import exit_description
+
+
+def parse_address(addr, default_host='localhost'):
+    """Return a (host, port) tuple for an address of the form [HOST:]PORT."""
+    host, _, port = addr.rpartition(':')
+    return (host or default_host, int(port))
+
+
+def get_authkey(authkey=None):
+    """Return the authentication key given on the command line or in the
+    TESTFLO_AUTHKEY environment variable, or None if there isn't one.
+    """
+    if authkey is None:
+        authkey = os.environ.get('TESTFLO_AUTHKEY')
+    if authkey:
+        return authkey.encode()
+
+
+# how long a newly connected agent has to authenticate and tell us its name
+_HANDSHAKE_TIMEOUT = 30.
+
+
+class _Agent(object):
+    """
+    Keeps track of a connected agent and the work it has been given.
+
+    Attributes
+    ----------
+    conn : Connection
+        Connection to the agent.
+    name : str
+        Host name and process id of the agent.
+    inflight : deque
+        Test groups sent to the agent that haven't been reported back yet.
+    ndone : int
+        Number of tests in the first in-flight group that have been reported back.
+    started : float
+        Time when the agent was sent its current test group.
+    deadline : float or None
+        Time by which the agent must finish its current test group before it's
+        dropped. This is only a backstop for the watchdog inside the agent.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.inflight = deque()
+        self.ndone = 0
+        self.started = 0.
+        self.deadline = None
+
+    def send(self, tests, timeout):
+        """Send a test group to the agent, which must finish it within about timeout
+        seconds per test if timeout is nonzero.
+        """
+        self.conn.send([tests])
+        self.inflight.append(tests)
+        self.started = time.perf_counter()
+        if timeout:
+            ntests = sum(1 for test in tests)
+            self.deadline = self.started + timeout * ntests + max(timeout, 10.)
+
+
+class RemoteTestRunner(TestRunner):
+    """TestRunner that sends tests to remote testflo-agent processes.
+
+    If ordered is True, an earlier stage of the pipeline has already put the test groups
+    in the order they should run, so they are sent in that order.
+    """
+
+    def __init__(self, options, durations=None, ordered=False):
+        super(RemoteTestRunner, self).__init__(options, None)
+        self.options = options
+        # agents always have to authenticate, so it's safe to listen on all interfaces
+        self.address = parse_address(options.serve, default_host='')
+
+        authkey = get_authkey(options.authkey)
+        if authkey is None:
+            authkey = secrets.token_hex(16).encode()
+        self.authkey = authkey
+
+        self.durations = durations
+        # the groups may already have been sorted longest first within a better order
+        self.longest_first = (options.longest_first and durations is not None and
+                              not ordered)
+
+        self._agents = []
+        self._joined = deque()
+        self._wake_recv, self._wake_send = Pipe(duplex=False)
+        self._wake_lock = threading.Lock()
+        self._listener = None
+
+    def _accept(self, listener):
+        """Accept connections from agents until the listener is closed.
+
+        Each connection is authenticated on its own thread so that a client that
+        connects and then sends nothing can't keep other agents from joining.
+        """
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                if self._listener is None:
+                    break
+                continue
+            threading.Thread(target=self._handshake, args=(conn,), daemon=True).start()
+
+    def _handshake(self, conn):
+        """Authenticate a new connection and exchange the agent name for the options."""
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            if not conn.poll(_HANDSHAKE_TIMEOUT):
+                raise EOFError("agent didn't send its name")
+            name = conn.recv()
+            conn.send(self.options)
+        except (ProcessError, OSError, EOFError):
+            # bad authkey, not a testflo-agent, or the agent went away
+            try:
+                conn.close()
+            except OSError:
+                pass
+            return
+        self._joined.append(_Agent(conn, name))
+        with self._wake_lock:
+            self._wake_send.send(None)
+
+    def get_iter(self, input_iter):
+        """Run tests on remote agents."""
+
+        if self.longest_first:
+            input_iter = sorted(input_iter,
+                                key=lambda tests: sum(self.durations.estimate(t.spec)
+                                                      for t in tests),
+                                reverse=True)
+
+        # connections are authenticated in _handshake rather than by the listener
+        self._listener = Listener(self.address, backlog=64)
+        host, port = self._listener.address
+        if host in ('', '0.0.0.0', '::'):
+            host = socket.gethostname()
+        print("testflo: waiting for agents on %s:%d. Start them with:\n"
+              "    TESTFLO_AUTHKEY=%s testflo-agent %s:%d" %
+              (host, port, self.authkey.decode(), host, port), file=sys.stderr)
+        sys.stderr.flush()
+        agent_deadline = (time.time() + self.options.agent_wait
+                          if self.options.agent_wait > 0 else None)
+
+        accepter = threading.Thread(target=self._accept, args=(self._listener,),
+                                    daemon=True)
+        accepter.start()
+
+        source = iter(input_iter)
+        # groups from agents that went away before running them, and reruns of failed tests
+        retry = deque()
+        idle = deque()
+        exhausted = False
+        stopping = False
+
+        try:
+            while True:
+                while idle and not stopping:
+                    if retry:
+                        tests = retry.popleft()
+                    elif not exhausted:
+                        tests = next(source, None)
+                        if tests is None:
+                            exhausted = True
+                            break
+                    else:
+                        break
+                    agent = idle.popleft()
+                    try:
+                        agent.send(tests, self.options.timeout)
+                    except OSError:
+                        self._agents.remove(agent)
+                        retry.appendleft(tests)
+                        continue
+
+                busy = [a for a in self._agents if a.inflight]
+                if not busy and (stopping or (exhausted and not retry)):
+                    if stopping:
+                        # reruns that won't happen now still have to report their
+                        # failures
+                        for tests in retry:
+                            for test in tests:
+                                failed = self.reruns.abandon(test)
+                                if failed is not None:
+                                    yield failed
+                    break
+
+                if self._agents or agent_deadline is None:
+                    timeout = None
+                    if self._agents and agent_deadline is not None:
+                        # start the clock again if all of the agents go away
+                        agent_deadline = time.time() + self.options.agent_wait
+                else:
+                    timeout = max(0., agent_deadline - time.time())
+                deadlines = [a.deadline for a in busy if a.deadline is not None]
+                if deadlines:
+                    hang_timeout = max(0., min(deadlines) - time.perf_counter())
+                    timeout = hang_timeout if timeout is None else min(timeout, hang_timeout)
+                ready = wait([self._wake_recv] + [a.conn for a in busy], timeout=timeout)
+
+                hung = []
+                if not ready:
+                    now = time.perf_counter()
+                    hung = [a for a in busy if a.deadline is not None and a.deadline <= now]
+                    if not hung:
+                        if (not self._agents and agent_deadline is not None and
+                                time.time() >= agent_deadline):
+                            # nobody showed up, so don't wait forever
+                            for result in self._no_agents(retry, source):
+                                yield result
+                            break
+                        continue  # woke up a little early
+                    ready = [a.conn for a in hung]
+
+                for obj in ready:
+                    if obj is self._wake_recv:
+                        self._wake_recv.recv()
+                        while self._joined:
+                            agent = self._joined.popleft()
+                            self._agents.append(agent)
+                            idle.append(agent)
+                        continue
+
+                    agent = [a for a in busy if a.conn is obj][0]
+                    if agent in hung:
+                        # its watchdog should have stopped it long ago
+                        results = self._agent_lost(agent, retry, hung=True)
+                        last = False
+                    else:
+                        try:
+                            msgs, last = agent.conn.recv()
+                        except (EOFError, OSError):
+                            results = self._agent_lost(agent, retry)
+                            last = False
+                        else:
+                            group = list(agent.inflight[0])
+                            results = merge_results(group[agent.ndone:], msgs)
+                            agent.ndone += len(results)
+                            if last:
+                                agent.inflight.clear()
+                                agent.ndone = 0
+                                agent.deadline = None
+                                idle.append(agent)
+                            elif agent.ndone >= len(group):
+                                agent.inflight.popleft()
+                                agent.ndone = 0
+
+                    for result in results:
+                        again = self.reruns.rerun(result)
+                        if again is not None:
+                            # run it again on the next free agent
+                            retry.appendleft([again])
+                            continue
+                        result = self.reruns.finish(result)
+                        yield result
+                        if self.stop and _is_failure(result):
+                            # finish whatever the agents are running, but don't
+                            # start anything new
+                            stopping = True
+        finally:
+            listener = self._listener
+            self._listener = None
+            for agent in self._agents:
+                try:
+                    agent.conn.send('STOP')
+                    agent.conn.close()
+                except OSError:
+                    pass
+            listener.close()
+
+    def _no_agents(self, retry, source):
+        """Fail every test that hasn't been run because no agents connected in time."""
+        msg = ("No testflo-agent connected within %s seconds (see --agent-wait)." %
+               self.options.agent_wait)
+        print("testflo: %s" % msg, file=sys.stderr)
+        for tests in list(retry) + list(source):
+            for test in tests:
+                test.status = 'FAIL'
+                test.err_msg = msg
+                yield test
+
+    def _agent_lost(self, agent, retry, hung=False):
+        """Fail the tests that a lost agent hadn't finished in the group it was running,
+        put the rest of its work back to be run by other agents, and return the failed
+        tests.
+
+        If hung is True, the agent is still connected but has gone past the deadline
+        for its test group, so it is dropped.
+        """
+        self._agents.remove(agent)
+        tests = list(agent.inflight.popleft())[agent.ndone:]
+        retry.extendleft(reversed(agent.inflight))
+        agent.inflight.clear()
+
+        timeout = self.options.timeout
+        if hung:
+            try:
+                agent.conn.close()
+            except OSError:
+                pass
+            msg = ("Agent %s was dropped because this test group ran well past the "
+                   "%s second timeout." % (agent.name, timeout))
+        elif timeout and time.perf_counter() - agent.started >= timeout:
+            # the agent's watchdog stops the agent when a test times out
+            msg = ("Agent %s disconnected after this test group ran for longer than the "
+                   "%s second timeout." % (agent.name, timeout))
+        else:
+            msg = "Agent %s disconnected while running this test." % agent.name
+
+        results = []
+        for test in tests:
+            test.status = 'FAIL'
+            test.err_msg = msg
+            results.append(test)
+        return results
+
+
+class _ConnQueue(object):
+    """Makes a Connection look enough like a Queue to be used by the worker function."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            return 'STOP'
+
+
+# exit code of an agent process that couldn't connect to the coordinator
+_NO_COORDINATOR = 75
+
+
+def run_agent(address, authkey, wait_time=60., dump_file=None):
+    """Connect to a coordinator and run the tests it sends until it tells us to stop.
+
+    If the coordinator isn't accepting connections yet, keep trying for wait_time seconds.
+    Returns False if we never managed to connect.
+
+    If the coordinator gives a --timeout and dump_file is given, any test that takes
+    longer than the timeout causes its spec and the python stacks of the agent to be
+    written to dump_file, after which the agent exits.
+    """
+    deadline = time.time() + wait_time
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                return False
+            time.sleep(1.)
+        except (EOFError, OSError):
+            return True  # the coordinator finished while we were connecting
+
+    name = "%s:%d" % (socket.gethostname(), os.getpid())
+    try:
+        conn.send(name)
+        options = conn.recv()
+    except (EOFError, OSError):
+        return True  # the coordinator finished before we could do anything
+
+    # set this so code will know when it's running under testflo
+    os.environ['TESTFLO_RUNNING'] = '1'
+
+    try:
+        worker(_ConnQueue(conn), conn, name, options,
+               dump_file if options.timeout else None)
+    except (EOFError, OSError):
+        pass  # the coordinator went away
+
+    return True
+
+
+def _agent_proc(address, authkey, wait_time, dump_file):
+    if not run_agent(address, authkey, wait_time, dump_file):
+        print("testflo-agent: couldn't connect to %s:%d" % address, file=sys.stderr)
+        sys.exit(_NO_COORDINATOR)
+
+
+def _get_agent_parser():
+    parser = ArgumentParser(description="Run tests for a testflo coordinator started "
+                                        "with --serve.")
+    parser.add_argument('address', metavar='HOST:PORT',
+                        help="Address of the coordinator.")
+    parser.add_argument('-n', '--numprocs', type=int, action='store', dest='num_procs',
+                        default=1, metavar='NUM_AGENTS',
+                        help="Number of agent processes to start on this machine. "
+                             "Default is 1.")
+    parser.add_argument('--authkey', action='store', dest='authkey', metavar='KEY',
+                        help="Authentication key printed by the coordinator. Defaults to "
+                             "the value of the TESTFLO_AUTHKEY environment variable.")
+    parser.add_argument('--wait', type=float, action='store', dest='wait_time', default=60.,
+                        metavar='SECONDS',
+                        help="How long to keep trying to connect if the coordinator isn't "
+                             "running yet. Default is 60 seconds.")
+    return parser
+
+
+def agent_main(args=None):
+    """Entry point for the testflo-agent command."""
+    options = _get_agent_parser().parse_args(args)
+
+    authkey = get_authkey(options.authkey)
+    if authkey is None:
+        print("testflo-agent: an authentication key is required. Use --authkey or set "
+              "TESTFLO_AUTHKEY.", file=sys.stderr)
+        return 1
+
+    address = parse_address(options.address)
+
+    def start(dump_file):
+        proc = Process(target=_agent_proc,
+                       args=(address, authkey, options.wait_time, dump_file))
+        proc.dump_file = dump_file
+        proc.start()
+        return proc
+
+    dump_files = []
+    for i in range(options.num_procs):
+        fd, dump_file = tempfile.mkstemp(prefix='testflo_agent_', suffix='.txt')
+        os.close(fd)
+        dump_files.append(dump_file)
+
+    procs = [start(dump_file) for dump_file in dump_files]
+
+    # replace any agent that is killed by one of its tests or by its watchdog
+    try:
+        while procs:
+            wait([proc.sentinel for proc in procs])
+            for proc in list(procs):
+                if not proc.is_alive():
+                    proc.join()
+                    procs.remove(proc)
+                    if proc.exitcode not in (0, _NO_COORDINATOR):
+                        spec, stacks = _read_dump(proc.dump_file)
+                        running = " while running %s" % spec if spec else ""
+                        print("testflo-agent: agent process %s%s, starting a new one." %
+                              (exit_description(proc.exitcode), running), file=sys.stderr)
+                        if stacks:
+                            print("The test timed out with these stacks:\n%s" % stacks,
+                                  file=sys.stderr)
+                        procs.append(start(proc.dump_file))
+    finally:
+        for dump_file in dump_files:
+            try:
+                os.remove(dump_file)
+            except OSError:
+                pass
+
+    return 0
+
+
+def _read_dump(dump_file):
+    """Return (spec, stacks) for the last test started by an agent that has exited, where
+    stacks is empty unless the agent's watchdog stopped it.
+    """
+    try:
+        with open(dump_file) as f:
+            spec, _, stacks = f.read().partition('\n')
+    except OSError:
+        return None, ''
+    return spec or None, stacks.strip()
+
+
+if __name__ == '__main__':
+    sys.exit(agent_main())
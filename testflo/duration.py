@@ -1,6 +1,9 @@
 import sys
 import os
 
+from testflo.runner import ABORT
+
+
 class DurationSummary(object):
     """Writes a summary of the tests taking the longest time."""
 
@@ -44,3 +47,28 @@ class DurationSummary(object):
                 break
 
         write("\n" + "=" * (len(title) + 2 * len(eqs)) + "\n")
+
+
+class DurationRecorder(object):
+    """Records the duration of each test so that later runs can schedule the
+    longest tests first.
+    """
+
+    def __init__(self, durations):
+        self.durations = durations
+
+    def get_iter(self, input_iter):
+        seen = set()
+
+        for tests in input_iter:
+            for test in tests:
+                # subtests share the spec and timing of their parent test
+                if test.spec not in seen:
+                    seen.add(test.spec)
+                    # a start_time of 0 means the test never got to run
+                    if (test.status not in (None, ABORT) and not test.cached and
+                            test.start_time):
+                        self.durations.update(test.spec, test.end_time - test.start_time)
+                yield test
+
+        self.durations.save()
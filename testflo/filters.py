@@ -1,6 +1,11 @@
 from __future__ import print_function
 
 import os
+import zlib
+import functools
+
+from testflo.util import get_testpath, fpath2modpath
+from testflo.cache import spec_key
 
 
 class TimeFilter(object):
@@ -46,3 +51,191 @@ class FailFilter(object):
                         spec = result.spec
                     print(spec, file=f)
             yield result
+
+
+class ShardFilter(object):
+    """This iterator passes on only the groups of tests that belong to one shard
+    out of shard_count, so a test suite can be split across several machines.
+
+    Groups are never split, so tests that share module or class fixtures always run
+    in the same shard.  Tests are identified by module path rather than file path
+    (e.g., pkg.test_foo:TestFoo.test_bar), so the shards don't depend on where each
+    machine checked out the code.  If durations are given, groups are assigned to
+    shards longest first, each going to the shard with the least total time so far.
+    Otherwise each group is assigned based on a hash of its test names.  Either way
+    the assignment only depends on the tests found and the given durations, so every
+    machine running the same tests with the same durations file computes the same
+    shards.
+    """
+    def __init__(self, shard, shard_count, durations=None):
+        self.shard = shard
+        self.shard_count = shard_count
+        if durations is not None and len(durations) > 0:
+            self.durations = {_test_name(spec): d for spec, d in durations.items()}
+            self.default = sum(self.durations.values()) / len(self.durations)
+        else:
+            self.durations = None
+
+    def get_iter(self, input_iter):
+        if self.durations is None:
+            for tests in input_iter:
+                if zlib.crc32(_group_key(tests).encode()) % self.shard_count == self.shard:
+                    yield tests
+            return
+
+        groups = []
+        for tests in input_iter:
+            tests = list(tests)
+            cost = sum(self.durations.get(_test_name(t.spec), self.default) for t in tests)
+            groups.append((-cost, _group_key(tests), tests))
+
+        # sort by name to break ties so that discovery order doesn't matter
+        groups.sort(key=lambda g: g[:2])
+
+        loads = [0.] * self.shard_count
+        for cost, _, tests in groups:
+            i = loads.index(min(loads))
+            loads[i] -= cost
+            if i == self.shard:
+                yield tests
+
+
+@functools.lru_cache(maxsize=4096)
+def _module_name(testpath):
+    """Return the module path for the given test file, or the given name if it isn't a file."""
+    if testpath.endswith('.py'):
+        return fpath2modpath(testpath)
+    return testpath
+
+
+def _test_name(spec):
+    """Return the given test spec with its module path instead of its file path."""
+    testpath, rest = get_testpath(spec)
+    return ':'.join((_module_name(testpath), rest)) if rest else _module_name(testpath)
+
+
+def _group_key(tests):
+    """Return a name for the given group of tests that doesn't depend on discovery order
+    or on where the tests are found on the file system.
+    """
+    names = sorted(_test_name(t.spec) for t in tests)
+    if len(names) == 1:
+        return names[0]
+    return os.path.commonprefix(names)
+
+
+class ChangedFilter(object):
+    """This iterator passes on only the groups of tests that may be affected by
+    the given set of changed files, based on the source files that each test
+    executed in an earlier run using coverage with --cover-contexts.  Tests with no
+    recorded dependencies are always run, and a group is passed on whole if any of
+    its tests is affected.
+    """
+    def __init__(self, changed, depmap):
+        self.changed = changed
+        self.depmap = depmap
+
+    def get_iter(self, input_iter):
+        for tests in input_iter:
+            if any(self.depmap.is_affected(t.spec, self.changed) for t in tests):
+                yield tests
+
+
+class ResultCacheFilter(object):
+    """This iterator marks every test in a group as passed (cached) if each of them
+    passed in an earlier run and none of the files they used have changed since.
+    Those tests won't actually be run.  Groups are never split, so if any test in a
+    group has to run, they all do.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_iter(self, input_iter):
+        for tests in input_iter:
+            tests = list(tests)
+            if all(t.status is None and self.cache.is_current(t.spec) for t in tests):
+                for test in tests:
+                    test.status = 'OK'
+                    test.cached = True
+            yield tests
+
+
+class ResultCacheRecorder(object):
+    """This iterator records each test that passes, along with the source files it
+    used, in the result cache, and removes any test that didn't pass from it.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_iter(self, input_iter):
+        for result in input_iter:
+            for test in result:
+                if test.cached:
+                    pass
+                elif (test.status == 'OK' and not test.expected_fail and
+                        test.deps is not None and not hasattr(test, 'submsg')):
+                    self.cache.put(test.spec, test.deps)
+                else:
+                    self.cache.remove(test.spec)
+                yield test
+
+        self.cache.save()
+
+
+class PriorityFilter(object):
+    """This iterator reorders the groups of tests so that the ones most likely to need
+    attention run first.  If failed is given (--failed-first), groups containing a test
+    that failed the last time it was run come first, followed by groups from test files
+    modified since the previous run (newest first), followed by everything else.
+    If flaky rates are given (--reruns), groups containing tests that have been flaky in
+    recent runs come first within each of those tiers, most often flaky first, so that
+    any reruns they need happen while the rest of the tests are running rather than at
+    the end.  A failure always wins over a flaky rate.  Groups are never split, so tests
+    that share module or class fixtures still run together.  Otherwise groups keep their
+    discovery order, or if durations are given, the longest run first.
+
+    Sorting means the whole discovery stream is collected before the first group is
+    passed on, so no test starts until discovery is finished.
+    """
+    def __init__(self, failed=None, since=None, flaky=None, durations=None):
+        self.failed = failed
+        self.since = since
+        self.flaky = flaky
+        self.durations = durations
+
+    def get_iter(self, input_iter):
+        mtimes = {}
+
+        def mtime(test):
+            testpath, _ = get_testpath(test.spec)
+            try:
+                return mtimes[testpath]
+            except KeyError:
+                try:
+                    mtimes[testpath] = t = os.path.getmtime(testpath)
+                except OSError:
+                    mtimes[testpath] = t = 0.
+                return t
+
+        groups = []
+        for tests in input_iter:
+            tests = list(tests)
+            keys = [spec_key(t.spec) for t in tests] if self.failed or self.flaky else ()
+            if self.failed is None:
+                key = ()
+            elif self.failed and any(k in self.failed for k in keys):
+                key = (0, 0.)
+            else:
+                newest = max(mtime(t) for t in tests)
+                key = (1, -newest) if newest > self.since else (2, 0.)
+            if self.flaky:
+                key += (-max(self.flaky.get(k, 0.) for k in keys),)
+            if self.durations is not None:
+                key += (-sum(self.durations.estimate(t.spec) for t in tests),)
+            groups.append((key, tests))
+
+        # the sort is stable, so discovery order is kept for equal keys
+        groups.sort(key=lambda g: g[0])
+
+        for _, tests in groups:
+            yield tests
@@ -0,0 +1,14 @@
+"""
+Importing this module moves everything that survives a garbage collection into the
+permanent generation.
+
+It's preloaded last by the forkserver that concurrent worker processes are forked
+from when --preload is used, so that the workers don't touch (and therefore don't
+copy) the pages holding the preloaded modules when they collect garbage.
+"""
+
+import gc
+
+gc.collect()
+if hasattr(gc, 'freeze'):
+    gc.freeze()
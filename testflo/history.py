@@ -0,0 +1,378 @@
+"""
+A history of test runs kept in a local SQLite database.
+
+When testflo is run with --history, the status, duration, memory usage, load,
+worker and run type of every test are stored in <cache_dir>/history.sqlite,
+along with a summary of the run.  Only the most recent runs are kept (see
+--history-max-runs).
+
+The testflo-history command queries the database, e.g.,
+
+    testflo-history runs
+    testflo-history test 'test_foo.py:*'
+    testflo-history slowest
+    testflo-history flaky
+
+The database is also where scheduling decisions that depend on past outcomes come
+from: --failed-first uses the tests that failed the last time they ran, and records
+history itself, and --reruns runs tests with a high flaky rate first if there is a
+database to read them from.
+
+Some data is still kept in other files in the cache directory because it isn't a
+record of test outcomes: durations.json holds smoothed durations that --longest-first
+and --batch-time need whether or not history is recorded, and that can be shared
+between machines for --shard-durations; results.pkl and test_deps.pkl hold file
+digests and coverage data for the result cache and --changed; failtests.in is the
+user-facing output of -f/--fail.
+"""
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+from argparse import ArgumentParser
+
+from testflo.cache import spec_key
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,
+    end REAL,
+    host TEXT,
+    args TEXT,
+    num_procs INTEGER,
+    passed INTEGER,
+    failed INTEGER,
+    skipped INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    spec TEXT NOT NULL,
+    submsg TEXT,
+    status TEXT,
+    expected_fail INTEGER,
+    elapsed REAL,
+    memory REAL,
+    worker_rss REAL,
+    load REAL,
+    worker TEXT,
+    run_type TEXT,
+    cached INTEGER
+);
+CREATE INDEX IF NOT EXISTS results_spec ON results (spec, run_id);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+"""
+
+
+def get_history_file(cache_dir):
+    """Return the name of the history database in the given cache directory."""
+    return os.path.join(cache_dir, 'history.sqlite')
+
+
+def _run_type(test):
+    if test.mpi and test.nprocs > 0:
+        return 'mpi'
+    elif test.isolated:
+        return 'isolated'
+    return 'serial'
+
+
+def _passed(status, expected_fail):
+    if status == 'FLAKY':
+        return True
+    return (status == 'OK') != bool(expected_fail)
+
+
+class HistoryDB(object):
+    """
+    A connection to the test history database.
+
+    Attributes
+    ----------
+    fname : str
+        Name of the database file.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        self._conn = sqlite3.connect(fname, timeout=30.)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def start_run(self, args, num_procs):
+        """Add a new run and return its id."""
+        with self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO runs (start, host, args, num_procs) VALUES (?, ?, ?, ?)",
+                (time.time(), socket.gethostname(), ' '.join(args), num_procs))
+        return cur.lastrowid
+
+    def add_results(self, run_id, tests):
+        """Add the results of the given tests to the given run.
+
+        Specs are stored with the real paths of their files, so that results of the same
+        test run from different directories are grouped together.
+        """
+        # a start_time of 0 means the test never got to run, so it has no elapsed time
+        rows = [(run_id, spec_key(t.spec), getattr(t, 'submsg', None), t.status,
+                 int(t.expected_fail), t.elapsed() if t.start_time else None,
+                 t.memory_usage, t.worker_rss, t.load[0],
+                 None if t.worker_id is None else str(t.worker_id), _run_type(t),
+                 int(t.cached))
+                for t in tests]
+        with self._conn:
+            self._conn.executemany("INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+    def end_run(self, run_id, passed, failed, skipped):
+        """Record the end of the given run and its totals."""
+        with self._conn:
+            self._conn.execute(
+                "UPDATE runs SET end = ?, passed = ?, failed = ?, skipped = ? WHERE id = ?",
+                (time.time(), passed, failed, skipped, run_id))
+
+    def prune(self, max_runs):
+        """Remove all but the most recent max_runs runs."""
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM runs WHERE id NOT IN "
+                "(SELECT id FROM runs ORDER BY id DESC LIMIT ?)", (max_runs,))
+
+    def runs(self, limit=20):
+        """Return rows of (id, start, end, host, num_procs, passed, failed, skipped, args)
+        for the most recent runs, newest first.
+        """
+        return self._conn.execute(
+            "SELECT id, start, end, host, num_procs, passed, failed, skipped, args "
+            "FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    def test_history(self, pattern, limit=20):
+        """Return rows of (run_id, start, spec, submsg, status, expected_fail, elapsed,
+        memory, worker, run_type, cached) for tests whose spec matches the given glob
+        pattern, newest first.
+        """
+        return self._conn.execute(
+            "SELECT r.run_id, runs.start, r.spec, r.submsg, r.status, r.expected_fail, "
+            "r.elapsed, r.memory, r.worker, r.run_type, r.cached "
+            "FROM results r JOIN runs ON runs.id = r.run_id "
+            "WHERE r.spec GLOB ? ORDER BY r.run_id DESC, r.spec LIMIT ?",
+            (pattern, limit)).fetchall()
+
+    def _recent_run_ids(self, runs):
+        return "SELECT id FROM runs ORDER BY id DESC LIMIT %d" % int(runs)
+
+    def slowest(self, runs=10, limit=20):
+        """Return rows of (spec, mean elapsed, max elapsed, number of runs) for the tests
+        with the longest mean duration over the most recent runs.
+        """
+        return self._conn.execute(
+            "SELECT spec, AVG(elapsed), MAX(elapsed), COUNT(DISTINCT run_id) FROM results "
+            "WHERE run_id IN (%s) AND status NOT IN ('SKIP', 'ABORT') AND NOT cached "
+            "AND submsg IS NULL AND elapsed IS NOT NULL "
+            "GROUP BY spec ORDER BY AVG(elapsed) DESC LIMIT ?" % self._recent_run_ids(runs),
+            (limit,)).fetchall()
+
+    def _flaky_counts(self, runs):
+        """Return a list of (spec, number of runs failed or flaky, number of runs) for
+        tests that both passed and failed over the most recent runs, or that passed on a
+        rerun (status FLAKY).
+        """
+        recent = self._recent_run_ids(runs)
+        rows = self._conn.execute(
+            "SELECT spec, run_id, status, expected_fail FROM results "
+            "WHERE run_id IN (%s) AND status NOT IN ('SKIP', 'ABORT') AND spec IN "
+            # only look at tests that didn't pass at least once
+            "(SELECT spec FROM results WHERE run_id IN (%s) AND (status = 'FLAKY' OR "
+            "(status = 'FAIL' AND NOT expected_fail) OR (status = 'OK' AND expected_fail)))"
+            % (recent, recent))
+
+        outcomes = {}
+        reran = set()
+        for spec, run_id, status, expected_fail in rows:
+            runs_seen = outcomes.setdefault(spec, {})
+            # a run fails if any subtest failed
+            ok = _passed(status, expected_fail) and status != 'FLAKY'
+            runs_seen[run_id] = runs_seen.get(run_id, True) and ok
+            if status == 'FLAKY':
+                reran.add(spec)
+
+        flaky = []
+        for spec, results in outcomes.items():
+            nfails = sum(1 for passed in results.values() if not passed)
+            if spec in reran or 0 < nfails < len(results):
+                flaky.append((spec, nfails, len(results)))
+        return flaky
+
+    def flaky(self, runs=10, limit=20):
+        """Return rows of (spec, number of runs failed or flaky, number of runs) for tests
+        that both passed and failed over the most recent runs, or that passed on a rerun
+        (status FLAKY), most often failing first.
+        """
+        flaky = self._flaky_counts(runs)
+        flaky.sort(key=lambda row: (-row[1] / row[2], row[0]))
+        return flaky[:limit]
+
+    def flaky_rates(self, runs=10):
+        """Return a dict of the fraction of the most recent runs in which each test listed
+        by flaky() failed or was flaky, keyed by spec with the real path of its file.
+        """
+        return {spec: nfails / nruns for spec, nfails, nruns in self._flaky_counts(runs)}
+
+    def last_failures(self):
+        """Return a set of the specs, with the real paths of their files, of the tests
+        that failed the last time they were run.
+        """
+        rows = self._conn.execute(
+            "SELECT DISTINCT r.spec FROM results r JOIN "
+            "(SELECT spec, MAX(run_id) AS run_id FROM results "
+            " WHERE status NOT IN ('SKIP', 'ABORT') GROUP BY spec) last "
+            "ON r.spec = last.spec AND r.run_id = last.run_id "
+            "WHERE r.status = 'FAIL' AND NOT r.expected_fail")
+        return {spec for spec, in rows}
+
+    def last_run_start(self):
+        """Return the start time of the most recent run, or None if there isn't one."""
+        return self._conn.execute("SELECT MAX(start) FROM runs").fetchone()[0]
+
+
+class HistoryRecorder(object):
+    """Records the result of every test in the history database, then prunes the
+    oldest runs.
+    """
+
+    def __init__(self, options, args):
+        self.options = options
+        self.args = args
+
+    def get_iter(self, input_iter):
+        db = HistoryDB(get_history_file(self.options.cache_dir))
+        run_id = db.start_run(self.args, self.options.num_procs)
+
+        passed = failed = skipped = 0
+        pending = []
+        seen = set()
+        try:
+            for result in input_iter:
+                for test in result:
+                    # count subtests of a test only once, like the summary does
+                    if test.spec not in seen:
+                        seen.add(test.spec)
+                        if test.status == 'SKIP':
+                            skipped += 1
+                        elif test.status == 'ABORT':
+                            pass  # it didn't get to finish, so it neither passed nor failed
+                        elif _passed(test.status, test.expected_fail):
+                            passed += 1
+                        else:
+                            failed += 1
+                    pending.append(test)
+                    if len(pending) >= 1000:
+                        db.add_results(run_id, pending)
+                        pending = []
+                    yield test
+        finally:
+            if pending:
+                db.add_results(run_id, pending)
+            db.end_run(run_id, passed, failed, skipped)
+            db.prune(self.options.history_max_runs)
+            db.close()
+
+
+def _time_str(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+
+def _print_table(header, rows, stream=sys.stdout):
+    rows = [[str(c) for c in row] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in rows]) for i, h in enumerate(header)]
+    for row in [header] + rows:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip(), file=stream)
+
+
+def _get_history_parser():
+    common = ArgumentParser(add_help=False)
+    common.add_argument('--cache-dir', action='store', dest='cache_dir', metavar='DIR',
+                        default='.testflo_cache',
+                        help="Directory containing the history database. Default is "
+                             ".testflo_cache.")
+    common.add_argument('-n', '--limit', type=int, action='store', dest='limit', default=20,
+                        help="Maximum number of rows to display. Default is 20.")
+    common.add_argument('--runs', type=int, action='store', dest='runs', default=10,
+                        help="For 'slowest' and 'flaky', the number of most recent runs to "
+                             "look at. Default is 10.")
+
+    parser = ArgumentParser(description="Query the history of test runs recorded by "
+                                        "testflo --history.")
+    sub = parser.add_subparsers(dest='command', metavar='COMMAND')
+    sub.required = True
+    sub.add_parser('runs', parents=[common], help="List the most recent runs.")
+    test = sub.add_parser('test', parents=[common],
+                          help="Show the results of matching tests in recent runs.")
+    test.add_argument('pattern', help="Glob pattern matching test specs, e.g., "
+                                      "'*test_foo.py:TestFoo.*'.")
+    sub.add_parser('slowest', parents=[common],
+                   help="List the tests with the longest mean duration.")
+    sub.add_parser('flaky', parents=[common],
+                   help="List tests that both passed and failed in recent runs.")
+    prune = sub.add_parser('prune', parents=[common],
+                           help="Remove all but the most recent runs.")
+    prune.add_argument('keep', type=int, help="Number of runs to keep.")
+    return parser
+
+
+def history_main(args=None):
+    """Entry point for the testflo-history command."""
+    options = _get_history_parser().parse_args(args)
+
+    fname = get_history_file(options.cache_dir)
+    if not os.path.isfile(fname):
+        print("testflo-history: no history found at '%s'. Run testflo with --history "
+              "to record it." % fname, file=sys.stderr)
+        return 1
+
+    db = HistoryDB(fname)
+    try:
+        if options.command == 'runs':
+            _print_table(['run', 'start', 'wall time', 'host', 'procs', 'passed', 'failed',
+                          'skipped', 'args'],
+                         [(i, _time_str(start), '' if end is None else '%.2f' % (end - start),
+                           host, nprocs, p, f, s, args)
+                          for i, start, end, host, nprocs, p, f, s, args in
+                          db.runs(options.limit)])
+        elif options.command == 'test':
+            rows = []
+            for (run_id, start, spec, submsg, status, xfail, elapsed, mem, worker,
+                    run_type, cached) in db.test_history(options.pattern, options.limit):
+                if cached:
+                    status += ' (cached)'
+                elif xfail:
+                    status += ' (expected fail)'
+                rows.append((run_id, _time_str(start), spec + (' ' + submsg if submsg else ''),
+                             status, '' if elapsed is None else '%.3f' % elapsed,
+                             '%d' % mem, worker or '', run_type))
+            _print_table(['run', 'start', 'test', 'status', 'elapsed', 'MB', 'worker',
+                          'type'], rows)
+        elif options.command == 'slowest':
+            _print_table(['test', 'mean', 'max', 'runs'],
+                         [(spec, '%.3f' % mean, '%.3f' % mx, n)
+                          for spec, mean, mx, n in db.slowest(options.runs, options.limit)])
+        elif options.command == 'flaky':
+            _print_table(['test', 'failed', 'runs'],
+                         db.flaky(options.runs, options.limit))
+        elif options.command == 'prune':
+            db.prune(options.keep)
+    finally:
+        db.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(history_main())
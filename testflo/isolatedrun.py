@@ -10,16 +10,15 @@ if __name__ == '__main__':
     import os
     import traceback
 
-    from testflo.test import Test
-    from testflo.qman import get_client_queue
+    from testflo.test import Test, result_messages
+    from testflo.qman import get_client_result_file, put_result
     from testflo.options import get_options
     from testflo.cover import setup_coverage
 
-    queue = get_client_queue()
-    os.environ['TESTFLO_QUEUE'] = ''
+    result_file = get_client_result_file()
 
     options = get_options()
-    test = None
+    test = result = None
 
     if options.coverage or options.coveragehtml:
         cov = setup_coverage(options)
@@ -28,16 +27,18 @@ if __name__ == '__main__':
 
     try:
         test = Test(sys.argv[1], options)
-        test.nocapture = True # so we don't lose stdout
-        test.run(cov=cov)
+        if os.environ.get('TESTFLO_OWN_FIXTURES'):
+            test.run_own_fixtures()
+        result = test.run(cov=cov, subprocs=False)
     except:
         test.status = 'FAIL'
         test.err_msg = traceback.format_exc()
+        result = test
     finally:
         sys.stdout.flush()
         sys.stderr.flush()
 
-        queue.put(test)
+        put_result(result_file, result_messages(result))
 
         if cov is not None:
             cov.save()
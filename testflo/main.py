@@ -33,19 +33,22 @@ import multiprocessing
 from fnmatch import fnmatch, fnmatchcase
 
 import testflo
-from testflo.runner import ConcurrentTestRunner
+from testflo.runner import TestRunner, ConcurrentTestRunner, SlotBudget
 from testflo.printer import ResultPrinter
 from testflo.benchmark import BenchmarkWriter
 from testflo.summary import ResultSummary
 from testflo.deprecations import DeprecationsReport
-from testflo.duration import DurationSummary
+from testflo.duration import DurationSummary, DurationRecorder
+from testflo.history import HistoryRecorder, HistoryDB, get_history_file
+from testflo.cache import DurationCache, TestDependencyMap, ResultCache, spec_key
 from testflo.discover import TestDiscoverer
-from testflo.filters import TimeFilter, FailFilter
-from testflo.cover import setup_coverage, finalize_coverage
+from testflo.filters import TimeFilter, FailFilter, ShardFilter, ChangedFilter, \
+                           ResultCacheFilter, ResultCacheRecorder, PriorityFilter
+from testflo.cover import setup_coverage, finalize_coverage, get_test_dependencies
+from testflo.zygote import start_zygote, stop_zygote
 
-from testflo.util import read_config_file, read_test_file
+from testflo.util import read_config_file, read_test_file, get_changed_files
 from testflo.options import get_options
-from testflo.qman import get_server_queue
 try:
     import coverage
 except ImportError:
@@ -192,6 +195,9 @@ def main(args=None):
     if not options.test_glob:
         options.test_glob = ['test*']
 
+    if options.fast_abort:
+        options.stop = True
+
     if options.benchmark:
         options.num_procs = 1
         options.isolated = True
@@ -216,24 +222,124 @@ def main(args=None):
 
     retval = 0
 
-    if options.isolated or not options.nompi:
-        # create a distributed queue and get a proxy to it
-        manager, queue = get_server_queue()
-    else:
-        manager, queue = (None, None)
-
     with report_file as report, benchmark_file as bdata:
         pipeline = [
             discoverer.get_iter,
         ]
 
+        if options.longest_first or options.batch_time > 0:
+            durations = DurationCache(options.cache_dir)
+        else:
+            durations = None
+
+        if options.changed_since or options.changed:
+            changed = set()
+            if options.changed_since:
+                changed.update(get_changed_files(options.changed_since))
+            for entry in options.changed:
+                changed.update(os.path.realpath(f.strip()) for f in entry.split(',')
+                               if f.strip())
+            depmap = TestDependencyMap(options.cache_dir)
+            if len(depmap) == 0:
+                print("testflo: no test dependencies found in '%s', so all tests will be "
+                      "run. Record them using --coverage --cover-contexts." %
+                      options.cache_dir, file=sys.stderr)
+            pipeline.append(ChangedFilter(changed, depmap).get_iter)
+
+        if options.shard:
+            index, count = options.shard
+            if options.shard_durations:
+                # every shard has to use the same durations, so don't use the ones
+                # recorded locally, which only cover the tests of this shard
+                shard_durations = DurationCache(None, fname=options.shard_durations)
+                if shard_durations.error or len(shard_durations) == 0:
+                    print("testflo: can't use the durations in '%s' (%s), so shards will "
+                          "be balanced by hashing test names." %
+                          (options.shard_durations, shard_durations.error or "it's empty"),
+                          file=sys.stderr)
+            else:
+                shard_durations = None
+            pipeline.append(ShardFilter(index - 1, count, shard_durations).get_iter)
+
+        if options.result_cache and not options.benchmark:
+            result_cache = ResultCache(options.cache_dir, options.result_cache_size)
+            if not options.force_rerun:
+                pipeline.append(ResultCacheFilter(result_cache).get_iter)
+        else:
+            result_cache = None
+
+        failed = since = flaky = None
+        if options.failed_first:
+            # the order comes from the history database, so this run has to be recorded
+            options.history = True
+        history_file = get_history_file(options.cache_dir)
+        if options.failed_first or (options.reruns > 0 and
+                                    (options.history or os.path.isfile(history_file))):
+            db = HistoryDB(history_file)
+            try:
+                if options.failed_first:
+                    failed = db.last_failures()
+                    since = db.last_run_start()
+                if options.reruns > 0:
+                    flaky = db.flaky_rates()
+            finally:
+                db.close()
+
+        if options.failed_first:
+            # read this now, because FailFilter replaces the file during the run
+            failfile = options.failfile or ('failtests.in' if options.save_fails else None)
+            if failfile and os.path.isfile(failfile):
+                failed.update(spec_key(spec) for spec in read_test_file(failfile))
+            # with no previous run, anything changed in the last day counts as recent
+            if since is None:
+                since = time.time() - 86400.
+
+        # only reorder if there's something to go on, because sorting has to wait for
+        # discovery to finish and keeps the runner from grouping tests by module
+        ordered = bool(options.failed_first or flaky)
+        if ordered:
+            pipeline.append(PriorityFilter(failed, since, flaky,
+                                           durations if options.longest_first
+                                           else None).get_iter)
+
         if options.dryrun:
             pipeline.append(dryrun)
         else:
             if options.pre_announce:
                 options.num_procs = 1
 
-            pipeline.append(ConcurrentTestRunner(options, queue, cov=cov).get_iter)
+            if options.serve:
+                from testflo.distributed import RemoteTestRunner
+                pipeline.append(RemoteTestRunner(options, durations=durations,
+                                                 ordered=ordered).get_iter)
+            elif options.async_subprocs:
+                from testflo.aiorunner import AsyncSubprocRunner
+                # the subprocesses and the worker processes count against the same limit
+                slot_budget = SlotBudget(options.core_slots if options.core_slots > 0
+                                         else options.num_procs)
+                if options.isolated:
+                    # only tests that can't be run in a subprocess are left for this
+                    inner = TestRunner(options, cov=cov)
+                else:
+                    inner = ConcurrentTestRunner(options, cov=cov, durations=durations,
+                                                 ordered=ordered, slot_budget=slot_budget)
+                pipeline.append(AsyncSubprocRunner(options, inner, slot_budget).get_iter)
+            else:
+                pipeline.append(ConcurrentTestRunner(options, cov=cov, durations=durations,
+                                                     ordered=ordered).get_iter)
+
+            if durations is not None and not (
+                    options.shard and options.shard_durations and
+                    os.path.realpath(options.shard_durations) ==
+                    os.path.realpath(durations.fname)):
+                # don't let a shard change the durations file that all shards share
+                pipeline.append(DurationRecorder(durations).get_iter)
+
+            if result_cache is not None:
+                pipeline.append(ResultCacheRecorder(result_cache).get_iter)
+
+            if options.history:
+                pipeline.append(HistoryRecorder(options, args).get_iter)
 
             if options.show_deprecations or options.deprecations_report:
                 pipeline.append(DeprecationsReport(options).get_iter)
@@ -267,12 +373,21 @@ def main(args=None):
                 options.failfile = 'failtests.in'
             pipeline.append(FailFilter(options.failfile).get_iter)
 
-        retval = run_pipeline(tests, pipeline, options.disallow_skipped)
+        if options.num_procs == 1 and not (options.serve or options.async_subprocs):
+            # isolated tests are run from this process, so start the zygote before
+            # discovery starts any threads or imports any tests
+            start_zygote(options)
+        try:
+            retval = run_pipeline(tests, pipeline, options.disallow_skipped)
+        finally:
+            stop_zygote()
 
-        if manager is not None:
-            manager.shutdown()
+    cov = finalize_coverage(options, cov)
 
-    finalize_coverage(options, cov)
+    if cov is not None and options.dyn_contexts:
+        depmap = TestDependencyMap(options.cache_dir)
+        depmap.update(get_test_dependencies(cov))
+        depmap.save()
 
     return retval
 
@@ -0,0 +1,419 @@
+"""
+Lightweight descriptions of the tests found in a test module.
+
+A ModuleInfo holds everything the TestDiscoverer needs to know about a test
+module (TestCase classes, their test methods, N_PROCS and ISOLATED values, and
+the presence of module or class level fixtures) without holding a reference to
+the module itself.  It can be built either by importing the module or, for
+modules simple enough to be understood without running them, by parsing the
+module source with the ast module.
+"""
+
+import sys
+import ast
+import builtins
+from inspect import getmembers, isclass, isfunction
+from unittest import TestCase
+
+from testflo.util import ismethod
+
+
+class ModuleInfo(object):
+    """
+    Describes the tests contained in a single test module.
+
+    Attributes
+    ----------
+    modpath : str
+        The python module path of the module.
+    mod_fixture : bool
+        True if the module defines setUpModule or tearDownModule.
+    tcases : dict
+        Maps TestCase class name to a tuple of the form
+        (has_class_fixture, N_PROCS, ISOLATED, method names).
+    funcs : list
+        List of (attribute name, function name) for module level functions.
+    unknowns : frozenset
+        Names bound in the module whose values couldn't be determined statically.
+        If any of these could be a test, the module must be imported.
+    deps : tuple
+        Files, other than the module's own file, that the tests found depend on, i.e.,
+        those defining base classes of the module's TestCases and, if the module was
+        imported, any other modules it imported.
+    """
+
+    __slots__ = ['modpath', 'mod_fixture', 'tcases', 'funcs', 'unknowns', 'deps']
+
+    def __init__(self, modpath, mod_fixture=False, tcases=None, funcs=None, unknowns=(),
+                 deps=()):
+        self.modpath = modpath
+        self.mod_fixture = mod_fixture
+        self.tcases = {} if tcases is None else tcases
+        self.funcs = [] if funcs is None else funcs
+        self.unknowns = frozenset(unknowns)
+        self.deps = tuple(deps)
+
+    def __getstate__(self):
+        return tuple(getattr(self, n) for n in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
+
+
+def _has_class_fixture(tcase):
+    if tcase is not None:
+        for klass in tcase.__mro__:
+            if klass is TestCase:
+                break
+            if 'setUpClass' in klass.__dict__ or 'tearDownClass' in klass.__dict__:
+                return  True
+    return False
+
+
+def _is_base_member(tcase, name):
+    # methods inherited unchanged from unittest.TestCase are never tests, so
+    # don't bother keeping track of them.
+    return getattr(TestCase, name, None) is getattr(tcase, name)
+
+
+def get_module_info(mod):
+    """Return a ModuleInfo for the given (already imported) module."""
+    tcases = {}
+    funcs = []
+    deps = set()
+    for name, obj in getmembers(mod):
+        if isclass(obj) and issubclass(obj, TestCase):
+            for klass in obj.__mro__:
+                if klass is TestCase:
+                    break
+                if klass.__module__ != mod.__name__:
+                    fname = getattr(sys.modules.get(klass.__module__), '__file__', None)
+                    if fname:
+                        deps.add(fname)
+            methods = tuple(n for n, _ in getmembers(obj, ismethod)
+                            if not _is_base_member(obj, n))
+            # use the class name unless the class is only reachable via an alias
+            tname = obj.__name__ if getattr(mod, obj.__name__, None) is obj else name
+            tcases[tname] = (_has_class_fixture(obj),
+                             getattr(obj, 'N_PROCS', 0),
+                             getattr(obj, 'ISOLATED', False),
+                             methods)
+        elif isfunction(obj):
+            funcs.append((name, obj.__name__))
+
+    mod_fixture = hasattr(mod, 'setUpModule') or hasattr(mod, 'tearDownModule')
+
+    return ModuleInfo(mod.__name__, mod_fixture, tcases, funcs, deps=sorted(deps))
+
+
+class _Unresolvable(Exception):
+    pass
+
+
+# calls that can add names to a namespace behind our back
+_dynamic_calls = {'setattr', 'exec', 'eval', 'globals', 'locals', 'vars', '__import__'}
+
+# method decorators with these in their name typically generate tests dynamically
+_generator_decorators = ('param', 'expand', 'generat')
+
+# class decorators from unittest that don't change which tests or fixtures a TestCase has
+_safe_class_decorators = {'skip', 'skipIf', 'skipUnless', 'expectedFailure'}
+
+_mod_fixture_names = {'setUpModule', 'tearDownModule'}
+_tcase_fixture_names = {'setUpClass', 'tearDownClass'}
+_mpi_attrs = {'N_PROCS': 0, 'ISOLATED': False}
+
+# builtin classes, none of which can be a TestCase
+_builtin_classes = {name for name, obj in vars(builtins).items() if isclass(obj)}
+
+
+def _looks_like_tcase(name):
+    return 'Test' in name or name.endswith('Case')
+
+
+def _dotted_name(node):
+    """Return 'a.b.c' for a Name or chain of Attributes, else None."""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+        return '.'.join(parts[::-1])
+
+
+class _StaticScanner(object):
+    """Collects test information from the parsed source of a test module."""
+
+    def __init__(self, modpath):
+        self.modpath = modpath
+        self.unittest_names = set()    # names bound to the unittest module
+        self.tcase_names = set()       # names bound to unittest.TestCase
+        self.safe_decorators = set()   # names bound to the unittest skip decorators
+        self.local_funcs = {}          # module level function name -> FunctionDef node
+        self.classes = {}              # local class name -> class info dict
+        self.funcs = []
+        self.unknowns = set()
+        self.mod_fixture = False
+
+    def scan(self, tree):
+        for stmt in tree.body:
+            self._module_stmt(stmt, toplevel=True)
+            self._check_dynamic(stmt)
+
+        tcases = {}
+        for name, cinfo in self.classes.items():
+            if self._is_tcase(cinfo):
+                fixture, nprocs, isolated, methods = self._resolve_class(cinfo)
+                tcases[name] = (fixture, nprocs, isolated, tuple(sorted(methods)))
+
+        return ModuleInfo(self.modpath, self.mod_fixture, tcases, self.funcs, self.unknowns)
+
+    def _check_dynamic(self, stmt):
+        # look for namespace manipulation anywhere that executes at import time.  Function
+        # bodies don't run at import time so skip them (but not their decorators).
+        nodes = [stmt]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                nodes.extend(node.decorator_list)
+                continue
+            if isinstance(node, ast.Lambda):
+                continue
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                if node.func.id in _dynamic_calls:
+                    raise _Unresolvable()
+                if node.func.id == 'type' and len(node.args) == 3:
+                    raise _Unresolvable()
+                if node.func.id in self.local_funcs:
+                    # a local function runs at import time, so check its body too
+                    func = self.local_funcs.pop(node.func.id)
+                    nodes.extend(func.body)
+            nodes.extend(ast.iter_child_nodes(node))
+
+    def _bind(self, name):
+        # a name was bound to something we can't determine statically
+        if name in _mod_fixture_names:
+            self.mod_fixture = True
+        if name in self.classes or _looks_like_tcase(name):
+            raise _Unresolvable()
+        self.unknowns.add(name)
+
+    def _check_class_decorators(self, node):
+        # a class decorator can add fixtures or tests or even replace the class, so
+        # only allow the ones from unittest that we know don't.
+        for dec in node.decorator_list:
+            if isinstance(dec, ast.Call):
+                dec = dec.func
+            head, _, tail = (_dotted_name(dec) or '').rpartition('.')
+            if not ((head in self.unittest_names and tail in _safe_class_decorators) or
+                    (not head and tail in self.safe_decorators)):
+                raise _Unresolvable()
+
+    def _check_decorators(self, node):
+        for dec in node.decorator_list:
+            if isinstance(dec, ast.Call):
+                dec = dec.func
+            dname = (_dotted_name(dec) or '').rpartition('.')[2].lower()
+            for s in _generator_decorators:
+                if s in dname:
+                    raise _Unresolvable()
+
+    def _module_stmt(self, stmt, toplevel):
+        if isinstance(stmt, ast.Import):
+            for alias in stmt.names:
+                if alias.asname is None:
+                    if alias.name.partition('.')[0] == 'unittest':
+                        self.unittest_names.add('unittest')
+                elif alias.name == 'unittest':
+                    self.unittest_names.add(alias.asname)
+        elif isinstance(stmt, ast.ImportFrom):
+            for alias in stmt.names:
+                name = alias.asname or alias.name
+                if stmt.module == 'unittest' and stmt.level == 0:
+                    if alias.name == '*':
+                        self.tcase_names.add('TestCase')
+                    elif alias.name == 'TestCase':
+                        self.tcase_names.add(name)
+                    elif alias.name in _safe_class_decorators:
+                        self.safe_decorators.add(name)
+                elif alias.name == '*':
+                    raise _Unresolvable()
+                else:
+                    self._bind(name)
+        elif isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if not toplevel:
+                raise _Unresolvable()
+            self._check_decorators(stmt)
+            if stmt.name in _mod_fixture_names:
+                self.mod_fixture = True
+            self.funcs.append((stmt.name, stmt.name))
+            self.local_funcs[stmt.name] = stmt
+        elif isinstance(stmt, ast.ClassDef):
+            if not toplevel:
+                raise _Unresolvable()
+            self._class_def(stmt)
+        elif isinstance(stmt, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+            for target in targets:
+                for node in ast.walk(target):
+                    if isinstance(node, ast.Name):
+                        # a plain alias of an existing local class gives us nothing new
+                        if not (isinstance(stmt.value, ast.Name) and
+                                stmt.value.id in self.classes):
+                            self._bind(node.id)
+        elif isinstance(stmt, ast.If) and _is_main_check(stmt.test):
+            pass
+        elif isinstance(stmt, (ast.If, ast.For, ast.While, ast.With, ast.Try)):
+            # conditionally executed code is fine as long as it doesn't define anything
+            # that could be a test
+            if isinstance(stmt, ast.For):
+                targets = [stmt.target]
+            elif isinstance(stmt, ast.With):
+                targets = [item.optional_vars for item in stmt.items if item.optional_vars]
+            else:
+                targets = []
+            for target in targets:
+                for node in ast.walk(target):
+                    if isinstance(node, ast.Name):
+                        self._bind(node.id)
+            for field in ('body', 'orelse', 'finalbody'):
+                for s in getattr(stmt, field, ()):
+                    self._module_stmt(s, toplevel=False)
+            for handler in getattr(stmt, 'handlers', ()):
+                for s in handler.body:
+                    self._module_stmt(s, toplevel=False)
+        elif isinstance(stmt, (ast.Expr, ast.Pass, ast.Assert, ast.Raise, ast.Break,
+                               ast.Continue)):
+            pass
+        else:
+            # e.g., del, match or try/except*, which could define or remove a test in
+            # ways that we don't follow
+            raise _Unresolvable()
+
+    def _class_def(self, node):
+        if node.keywords:  # metaclass or __init_subclass__ args
+            raise _Unresolvable()
+        self._check_class_decorators(node)
+
+        bases = []
+        for base in node.bases:
+            bname = _dotted_name(base)
+            if bname is None:
+                raise _Unresolvable()
+            head, _, tail = bname.rpartition('.')
+            if (bname in self.tcase_names or
+                    (tail == 'TestCase' and head in self.unittest_names)):
+                bases.append(TestCase)
+            elif bname in self.classes:
+                bases.append(self.classes[bname])
+            elif (bname in _builtin_classes and bname not in self.unknowns and
+                    bname not in self.local_funcs):
+                pass
+            else:
+                # a class from another module, e.g., a TestCase imported from a helper
+                # module.  It may be a TestCase that gives this class tests, fixtures or
+                # N_PROCS, so the module has to be imported.
+                raise _Unresolvable()
+
+        methods = set()
+        attrs = {}
+        fixture = False
+        for stmt in node.body:
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self._check_decorators(stmt)
+                methods.add(stmt.name)
+                if stmt.name in _tcase_fixture_names:
+                    fixture = True
+            elif isinstance(stmt, (ast.Assign, ast.AnnAssign)):
+                targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+                for target in targets:
+                    if not isinstance(target, ast.Name):
+                        raise _Unresolvable()
+                    if target.id in _mpi_attrs:
+                        try:
+                            attrs[target.id] = ast.literal_eval(stmt.value)
+                        except ValueError:
+                            raise _Unresolvable()
+                    elif target.id in _tcase_fixture_names:
+                        fixture = True
+                    else:
+                        self.unknowns.add(target.id)
+            elif isinstance(stmt, (ast.Expr, ast.Pass, ast.ClassDef)):
+                pass
+            else:
+                raise _Unresolvable()
+
+        self.classes[node.name] = {
+            'bases': bases,
+            'methods': methods,
+            'attrs': attrs,
+            'fixture': fixture,
+        }
+
+    def _is_tcase(self, cinfo):
+        for base in cinfo['bases']:
+            if base is TestCase or self._is_tcase(base):
+                return True
+        return False
+
+    def _resolve_class(self, cinfo):
+        """Return (fixture, nprocs, isolated, methods) for the given class, including
+        anything inherited from other classes in the same module.
+        """
+        fixture, attrs, methods = self._collect(cinfo)
+        return (fixture, attrs.get('N_PROCS', _mpi_attrs['N_PROCS']),
+                attrs.get('ISOLATED', _mpi_attrs['ISOLATED']), methods)
+
+    def _collect(self, cinfo):
+        fixture = cinfo['fixture']
+        attrs = dict(cinfo['attrs'])
+        methods = set(cinfo['methods'])
+        for base in cinfo['bases']:
+            if isinstance(base, dict):
+                bfixture, battrs, bmethods = self._collect(base)
+                fixture = fixture or bfixture
+                methods.update(bmethods)
+                for name, val in battrs.items():
+                    attrs.setdefault(name, val)
+        return fixture, attrs, methods
+
+
+def _is_main_check(node):
+    """Return True if node is the test of an "if __name__ == '__main__'" block."""
+    return (isinstance(node, ast.Compare) and isinstance(node.left, ast.Name) and
+            node.left.id == '__name__')
+
+
+def _has_tests(info, func_match):
+    """Return True if the given ModuleInfo describes any tests matching func_match."""
+    for _, _, _, methods in info.tcases.values():
+        if any(func_match(m) for m in methods):
+            return True
+    return any(func_match(name) for name, _ in info.funcs)
+
+
+def parse_module_info(fname, modpath, func_match):
+    """Return a ModuleInfo for the given file by parsing it rather than importing it,
+    or None if the tests in the module can't be determined without importing it.
+
+    func_match is a function that returns True if a function name is the name of a test.
+    """
+    try:
+        with open(fname, 'rb') as f:
+            tree = ast.parse(f.read(), filename=fname)
+    except (SyntaxError, ValueError, OSError):
+        return None  # let the import based discovery report the error
+
+    try:
+        info = _StaticScanner(modpath).scan(tree)
+    except _Unresolvable:
+        return None
+
+    if not _has_tests(info, func_match):
+        # the module may only get its tests, or fail, when it's imported, so import it
+        # to find out rather than quietly running nothing
+        return None
+
+    return info
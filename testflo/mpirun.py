@@ -15,19 +15,18 @@ if __name__ == '__main__':
     os.environ['OPENMDAO_USE_MPI'] = '1'
 
     from mpi4py import MPI
-    from testflo.test import Test
-    from testflo.qman import get_client_queue
+    from testflo.test import Test, ResultMsg, result_messages
+    from testflo.qman import get_client_result_file, put_result
     from testflo.options import get_options
     from testflo.cover import setup_coverage
 
     exitcode = 0  # use 0 for exit code of all ranks != 0 because otherwise,
                   # MPI will terminate other processes
 
-    queue = get_client_queue()
-    os.environ['TESTFLO_QUEUE'] = ''
+    result_file = get_client_result_file()
 
     options = get_options()
-    test = None
+    test = result = None
 
     if options.coverage or options.coveragehtml:
         cov = setup_coverage(options)
@@ -38,40 +37,50 @@ if __name__ == '__main__':
         try:
             comm = MPI.COMM_WORLD
             test = Test(sys.argv[1], options)
-            test.nocapture = True # so we don't lose stdout
-            test.run(cov=cov)
+            if os.environ.get('TESTFLO_OWN_FIXTURES'):
+                test.run_own_fixtures()
+            result = test.run(cov=cov, subprocs=False)
         except:
             print(traceback.format_exc())
             test.status = 'FAIL'
             test.err_msg = traceback.format_exc()
+            result = test
         else:
             # collect results
-            results = comm.gather(test, root=0)
+            msgs = result_messages(result)
+            all_msgs = comm.gather(msgs, root=0)
             if comm.rank == 0:
-                if not all([isinstance(r, Test) for r in results]):
-                    print("\nNot all results gathered are Test objects.  "
+                all_msgs = [r if isinstance(r, tuple) else (r,) for r in all_msgs]
+                if not all(isinstance(m, ResultMsg) for r in all_msgs for m in r):
+                    print("\nNot all results gathered are test results.  "
                           "You may have out-of-sync collective MPI calls.\n")
-                total_mem_usage = sum(r.memory_usage for r in results if isinstance(r, Test))
-                test.memory_usage = total_mem_usage
-
-                # check for errors and record error message
-                for r in results:
-                    if test.status != 'FAIL' and r.status in ('SKIP', 'FAIL'):
-                        test.err_msg = r.err_msg
-                        test.status = r.status
-                        if r.status == 'FAIL':
-                            break
+                for i, msg in enumerate(msgs):
+                    rank_msgs = [r[i] for r in all_msgs
+                                 if len(r) > i and isinstance(r[i], ResultMsg)]
+                    msg.memory_usage = sum(r.memory_usage for r in rank_msgs)
+
+                    # check for errors and record error message
+                    for r in rank_msgs:
+                        if msg.status != 'FAIL' and r.status in ('SKIP', 'FAIL'):
+                            msg.err_msg = r.err_msg
+                            msg.status = r.status
+                            if r.status == 'FAIL':
+                                break
+                result = msgs
 
     except Exception:
         test.err_msg = traceback.format_exc()
         test.status = 'FAIL'
+        result = test
 
     finally:
         sys.stdout.flush()
         sys.stderr.flush()
 
         if comm.rank == 0:
-            queue.put(test)
+            if not isinstance(result, tuple):
+                result = result_messages(result)
+            put_result(result_file, result)
 
         if cov is not None:
             cov.save()
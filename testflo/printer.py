@@ -8,8 +8,11 @@ _result_map = {
     ('FAIL', True): 'X',  # expected failure
     ('SKIP', False): 'S',
     ('SKIP', True): 'S',
+    ('ABORT', False): 'A',  # killed by --fast-abort
+    ('ABORT', True): 'A',
     ('OK', False): '.',
     ('OK', True): 'U',  # unexpected success
+    ('FLAKY', False): 'R',  # passed on a rerun
 }
 
 class ResultPrinter(object):
@@ -49,21 +52,28 @@ class ResultPrinter(object):
             else:
                 run_type = ''
 
+            if result.worker_rss:
+                mem = "%d MB, worker %d MB" % (result.memory_usage, result.worker_rss)
+            else:
+                mem = "%d MB" % result.memory_usage
+
             submsg = result.submsg if hasattr(result, 'submsg') else ''
-            if result.err_msg:
-                stream.write("%s%s %s ... %s (%s, %d MB)\n%s\n" % (
+            if result.cached:
+                stream.write("%s%s ... %s (cached)\n" % (run_type, result.spec, result.status))
+            elif result.err_msg:
+                stream.write("%s%s %s ... %s (%s, %s)\n%s\n" % (
                                                      run_type,
                                                      result.spec,
                                                      submsg,
                                                      result.status,
-                                                     stats, result.memory_usage,
+                                                     stats, mem,
                                                      result.err_msg))
             else:
-                stream.write("%s%s ... %s (%s, %d MB)\n" % (
+                stream.write("%s%s ... %s (%s, %s)\n" % (
                                                     run_type,
                                                     result.spec,
                                                     result.status,
-                                                    stats, result.memory_usage))
+                                                    stats, mem))
         else:
             stream.write(_result_map[(result.status, result.expected_fail)])
             if self.options.pre_announce:
@@ -1,42 +1,55 @@
+"""
+Passing of test results from test subprocesses (isolated or MPI) back to
+the testflo process that launched them.
+
+The launching process creates an empty result file and passes its name to the
+subprocess in the TESTFLO_RESULT_FILE environment variable.  The subprocess
+writes its pickled result into that file before it exits, and the launching
+process reads it back after the subprocess finishes.
+"""
 import os
-import sys
-
-import socket
-
-
-# pickling the queue proxy gets rid of the authkey, so use a fixed authkey here
-# for server and clients
-_testflo_authkey = b'foobarxxxx'
-
-def get_server_queue():
-    from multiprocessing.managers import SyncManager
-    #FIXME: some OSX users were getting "Can't assign requested address" errors
-    # if we use socket.gethostname() for the address. Changing it to
-    # 'localhost' seems to fix the issue, but I don't know why. We had to
-    # use socket.gethostname() in order to get our benchmark tests to run
-    # using qsub on a linux cluster, so with this 'fix', testflo benchmark tests
-    # will likely not work on a cluster of OSX machines.
-    if sys.platform == 'darwin':
-        addr = 'localhost'
-    else:
-        addr = socket.gethostname()
-
-    manager = SyncManager(address=(addr, 0), authkey=_testflo_authkey)
-    manager.start()
-    return manager, manager.Queue()
-
-def get_client_queue():
-    from multiprocessing.managers import RebuildProxy, AutoProxy, Token
-    qstr = os.environ.get('TESTFLO_QUEUE')
-
-    if qstr:
-        # if TESTFLO_QUEUE is set, use that info to create a proxy that
-        # points to the shared Queue.
-        addr0, addr1, token_id = qstr.split(':')
-        tok = Token('Queue', (addr0, int(addr1)), token_id)
-        queue = RebuildProxy(AutoProxy, tok, 'pickle',
-                             {'authkey':_testflo_authkey})
-    else:
-        queue = None
-
-    return queue
+import pickle
+import tempfile
+
+
+def get_result_file():
+    """Create an empty result file and return its name."""
+    fd, fname = tempfile.mkstemp(prefix='testflo_', suffix='.pkl')
+    os.close(fd)
+    return fname
+
+
+def get_client_result_file():
+    """In a test subprocess, return the name of the file where our result should be
+    written.  The environment variable is removed so that any testflo processes
+    started by the test itself won't also write to it.
+    """
+    return os.environ.pop('TESTFLO_RESULT_FILE', None)
+
+
+def put_result(fname, result):
+    """Write the given result to the given result file."""
+    if fname:
+        with open(fname, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+
+
+def get_result(fname):
+    """Read the result from the given result file, then remove the file."""
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    finally:
+        remove_result_file(fname)
+
+    if not data:
+        raise RuntimeError("No test result was received from the subprocess.")
+
+    return pickle.loads(data)
+
+
+def remove_result_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
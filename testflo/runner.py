@@ -5,48 +5,296 @@ from __future__ import print_function
 
 import sys
 import os
+import copy
+import time
+import tempfile
+import threading
+import faulthandler
+from collections import deque, OrderedDict
 
-from multiprocessing import Queue, Process
+import multiprocessing
+from multiprocessing.connection import wait, Pipe
 
 from testflo.cover import setup_coverage
+from testflo.test import Test, result_messages
+from testflo.zygote import get_preloads, start_zygote, stop_zygote
+from testflo.util import get_current_rss, exit_description, kill_process_tree
 
+# status and error message for tests that were killed while running when the run was
+# aborted after a failure.  They weren't skipped, so they don't count as skips.
+ABORT = 'ABORT'
+ABORT_MSG = "Test was not finished because the run was aborted after a failure."
 
-def worker(test_queue, done_queue, subproc_queue, worker_id, options):
-    """This is used by concurrent test processes. It takes a Test object
-    off of the test_queue, runs it, then puts the Test object
-    on the done_queue.
+
+def worker(test_queue, done_conn, worker_id, options, dump_file=None):
+    """This is used by concurrent test processes. It takes a batch of test
+    groups off of its own test_queue, runs them, then sends the ResultMsg for
+    each test through done_conn as soon as the test finishes, along with a flag
+    indicating whether the batch is done.
+
+    Each worker has its own connection for results so that a worker dying in the
+    middle of sending can't block the other workers.
+
+    If dump_file is given, any test run in this process that takes longer than
+    options.timeout causes the spec of the test and the python stacks of the
+    worker to be written to dump_file, after which the worker saves any coverage
+    data and exits.
     """
 
+    start_zygote(options)
+
     cov = setup_coverage(options)
 
+    dump = open(dump_file, 'w') if dump_file else None
+
     test_count = 0
     try:
-        for tests in iter(test_queue.get, 'STOP'):
+        for batch in iter(test_queue.get, 'STOP'):
 
-            done_tests = []
-            for test in tests:
-                try:
-                    test_count += 1
-                    done_tests.append(test.run(subproc_queue, cov=cov))
-                except:
-                    # we generally shouldn't get here, but just in case,
-                    # handle it so that the main process doesn't hang at the
-                    # end when it tries to join all of the concurrent processes.
-                    done_tests.append(test)
-
-            done_queue.put(done_tests)
+            for i, tests in enumerate(batch):
+                stop = False
+                tests = list(tests)
+                for j, test in enumerate(tests):
+                    watchdog = dump is not None and not _runs_in_subproc(test)
+                    if watchdog:
+                        dump.seek(0)
+                        dump.truncate()
+                        dump.write(test.spec + '\n')
+                        dump.flush()
+                        faulthandler.dump_traceback_later(options.timeout, file=dump)
+                        # give faulthandler time to write the stacks before exiting
+                        timer = threading.Timer(options.timeout + 1., _timed_out, (cov,))
+                        timer.daemon = True
+                        timer.start()
+                    try:
+                        test_count += 1
+                        result = test.run(cov=cov)
+                    except:
+                        # we generally shouldn't get here, but just in case,
+                        # handle it so that the main process doesn't hang at the
+                        # end when it tries to join all of the concurrent processes.
+                        result = test
+                    finally:
+                        if watchdog:
+                            timer.cancel()
+                            faulthandler.cancel_dump_traceback_later()
+                    if options.stop and _is_failure(result):
+                        stop = True
+
+                    rss = get_current_rss()
+                    for r in result:
+                        r.worker_rss = rss
+                        r.worker_id = worker_id
+
+                    # send each result right away so that a test that kills the worker
+                    # doesn't take the results of the rest of its group with it.  Don't
+                    # start the rest of the batch if we're going to stop anyway.
+                    last = j == len(tests) - 1 and (stop or i == len(batch) - 1)
+                    done_conn.send(([result_messages(result)], last))
+                if last:
+                    break
     finally:
         if cov:
             cov.save()
+        if dump is not None:
+            dump.close()
+        stop_zygote()
+
+
+def _timed_out(cov):
+    """End a worker whose current test has timed out, after saving its coverage data."""
+    try:
+        if cov:
+            cov.save()
+    finally:
+        os._exit(1)
+
+
+def get_worker_context(options):
+    """Return the multiprocessing context used to start concurrent worker processes.
+
+    If any modules are to be preloaded, the workers are forked from a forkserver
+    process that has already imported them, so each worker starts warm and shares
+    the memory holding those modules with the other workers.
+    """
+    modules = get_preloads(options)
+    if modules and 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(modules + ['testflo.gcfreeze'])
+        return ctx
+    return multiprocessing.get_context()
+
+
+def merge_results(tests, msgs):
+    """Return the results for the given group of tests, given the ResultMsgs for each
+    test sent by the worker that ran them.
+    """
+    return [test.merge(m) for test, m in zip(tests, msgs)]
+
+
+def _runs_in_subproc(test):
+    """Return True if the given test will be run in a subprocess of the worker."""
+    return test.subproc_kind() is not None
+
+
+def _is_failure(result):
+    """Return True if the given result (or any of its subtest results) should stop the run
+    when -x is active.
+    """
+    for r in result:
+        if (r.status == 'FAIL' and not r.expected_fail) or (
+                r.status == 'OK' and r.expected_fail):
+            return True
+    return False
+
+
+def _has_failed(result):
+    """Return True if the given result (or any of its subtest results) failed."""
+    return any(r.status == 'FAIL' and not r.expected_fail for r in result)
+
+
+class Reruns(object):
+    """
+    Decides which failed tests are run again when --reruns is active, and marks the
+    final result of a test that passed on a rerun as FLAKY.
+
+    Attributes
+    ----------
+    max_reruns : int
+        Maximum number of times to rerun a failed test.
+    time_budget : float
+        Total time that reruns may take, or 0 for no limit.
+    used : float
+        Time taken by reruns so far.
+    """
+
+    def __init__(self, options):
+        self.max_reruns = options.reruns
+        self.time_budget = options.reruns_time
+        self.used = 0.
+        if options.reruns_isolated and not options.isolated:
+            self._options = copy.copy(options)
+            self._options.isolated = True
+        else:
+            self._options = options
+        self._reruns = {}  # spec -> (number of reruns, error message of the first failure)
+        self._failed = {}  # spec -> (rerun Test, result of the failure it's rerunning)
+
+    def rerun(self, result):
+        """Return a new Test to run if the given result failed and may be rerun, else None."""
+        if self.max_reruns <= 0:
+            return None
+
+        test = next(iter(result))
+        count, first_err = self._reruns.get(test.spec, (0, None))
+        if count:
+            self.used += max(r.elapsed() for r in result)
+
+        if (not _has_failed(result) or count >= self.max_reruns or
+                0 < self.time_budget <= self.used):
+            return None
+
+        if first_err is None:
+            first_err = '\n'.join(r.err_msg for r in result if r.status == 'FAIL')
+        self._reruns[test.spec] = (count + 1, first_err)
+
+        new = Test(test.spec, self._options, info=test._info())
+        # the rest of its fixture group isn't coming along, so it needs its own fixtures
+        new.run_own_fixtures()
+        self._failed[test.spec] = (new, result)
+        return new
+
+    def abandon(self, test):
+        """Return the failed result that the given test was going to rerun, if it's a
+        rerun that won't be run after all because the run was stopped, else None.
+        """
+        entry = self._failed.get(test.spec)
+        if entry is None or entry[0] is not test:
+            return None
+        del self._failed[test.spec]
+        _, result = entry
+        count, first_err = self._reruns.pop(test.spec)
+        if count > 1:
+            # it has failed on the reruns before this one
+            self._reruns[test.spec] = (count - 1, first_err)
+            result = self.finish(result)
+        return result
+
+    def finish(self, result):
+        """Return the given final result of a test, marked as FLAKY if it passed after
+        being rerun.
+        """
+        if not self._reruns:
+            return result
+
+        self._failed.pop(next(iter(result)).spec, None)
+        for r in result:
+            entry = self._reruns.get(r.spec)
+            if entry is None:
+                break
+            count, first_err = entry
+            if r.status == 'OK' and not r.expected_fail:
+                r.status = 'FLAKY'
+                r.err_msg = "Passed on rerun %d after failing with:\n%s" % (count, first_err)
+            elif r.status == 'FAIL':
+                r.err_msg += "\n\nFailed again on %d rerun%s." % (count,
+                                                                  's' if count > 1 else '')
+        return result
+
+
+class SlotBudget(object):
+    """
+    Counts the core slots in use by the runners that start test processes, so that
+    runners working side by side in different threads never use more than --core-slots
+    between them.
+
+    Attributes
+    ----------
+    total : int
+        Number of core slots.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self._used = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def free(self):
+        """Return the number of slots not in use."""
+        return self.total - self._used
+
+    def take(self, n):
+        """Use n slots if that many are free.  Returns True if they were."""
+        with self._lock:
+            if self._used + n > self.total:
+                return False
+            self._used += n
+            return True
+
+    def release(self, n):
+        """Free n slots and tell anyone waiting for slots about it."""
+        if n:
+            with self._lock:
+                self._used -= n
+            for listener in list(self._listeners):
+                listener()
+
+    def add_listener(self, func):
+        """Call func, from whatever thread released them, whenever slots are freed."""
+        self._listeners.append(func)
+
+    def remove_listener(self, func):
+        self._listeners.remove(func)
 
 
 class TestRunner(object):
 
-    def __init__(self, options, subproc_queue, cov):
+    def __init__(self, options, cov):
         self.stop = options.stop
         self.pre_announce = options.pre_announce
-        self._queue = subproc_queue
         self.cov = cov
+        self.reruns = Reruns(options)
 
     def get_iter(self, input_iter):
         """Run tests serially."""
@@ -57,13 +305,16 @@ class TestRunner(object):
                 if self.pre_announce:
                     print("    about to run %s " % test.short_name(), end='')
                     sys.stdout.flush()
-                result = test.run(self._queue, cov=self.cov)
+                result = test.run(cov=self.cov)
+                again = self.reruns.rerun(result)
+                while again is not None:
+                    result = again.run(cov=self.cov)
+                    again = self.reruns.rerun(result)
+                result = self.reruns.finish(result)
                 yield result
-                if self.stop:
-                    if (result.status == 'FAIL' and not result.expected_fail) or (
-                                  result.status == 'OK' and result.expected_fail):
-                          stop = True
-                          break
+                if self.stop and _is_failure(result):
+                    stop = True
+                    break
             if stop:
                 break
 
@@ -71,70 +322,605 @@ class TestRunner(object):
 class ConcurrentTestRunner(TestRunner):
     """TestRunner that uses the multiprocessing package
     to execute tests concurrently.
+
+    If ordered is True, an earlier stage of the pipeline has already put the test groups
+    in the order they should run, so they are dispatched in that order.
+
+    If slot_budget is given, the core slots are shared with another runner, e.g., the
+    AsyncSubprocRunner, that is running tests at the same time.
     """
 
-    def __init__(self, options, subproc_queue, cov):
-        super(ConcurrentTestRunner, self).__init__(options, subproc_queue, cov)
+    def __init__(self, options, cov, durations=None, ordered=False, slot_budget=None):
+        super(ConcurrentTestRunner, self).__init__(options, cov)
         self.num_procs = options.num_procs
+        self.durations = durations
+        self.longest_first = options.longest_first and durations is not None
+        # keep the order of the groups given to us rather than grouping them by module
+        self.presorted = ordered
+        self.ordered = self.longest_first or ordered
+        self.batch_time = options.batch_time if durations is not None else 0.
 
         # only do concurrent stuff if num_procs > 1
         if self.num_procs > 1:
             self.get_iter = self.run_concurrent_tests
 
-            # Create queues
-            self.task_queue = Queue()
-            self.done_queue = Queue()
-            self.procs = []
+            # maximum number of batches to read ahead of the workers when looking
+            # for a batch that a worker has already imported the modules for
+            self.max_pending = 10000
+            # maximum time to spend reading ahead once there is something to run, so
+            # that workers aren't kept idle while discovery is still streaming tests in
+            self.read_ahead_time = 0.05
 
-            # Start worker processes
-            for i in range(self.num_procs):
-                worker_id = "%d_%d" % (os.getpid(), i)
-                self.procs.append(Process(target=worker,
-                                          args=(self.task_queue,
-                                                self.done_queue, subproc_queue,
-                                                worker_id, options)))
+            # each in-flight serial test uses one core slot and each MPI test uses one
+            # slot per rank
+            if slot_budget is None:
+                slot_budget = SlotBudget(options.core_slots if options.core_slots > 0
+                                         else self.num_procs)
+                self._wake_recv = None
+            else:
+                # another runner may free slots that we're waiting for
+                self._wake_recv, self._wake_send = Pipe(duplex=False)
+                self._woken = False
+            self.slot_budget = slot_budget
+            self.core_slots = slot_budget.total
 
-            for proc in self.procs:
-                proc.start()
+            self.options = options
+            self.context = get_worker_context(options)
+            self.workers = [_WorkerProc(i, options, self.context, slot_budget)
+                            for i in range(self.num_procs)]
+            self.retired = []
+
+            # Start worker processes
+            for w in self.workers:
+                w.start()
 
     def run_concurrent_tests(self, input_iter):
         """Run tests concurrently."""
 
-        it = iter(input_iter)
-        numtests = 0
-        try:
-            for proc in self.procs:
-                self.task_queue.put(next(it))
-                numtests += 1
-        except StopIteration:
-            pass
+        if self.longest_first and not self.presorted:
+            # dispatch the longest running groups first so that a long test found
+            # late in discovery doesn't leave the other workers idle at the end.
+            input_iter = sorted(input_iter, key=self._group_cost, reverse=True)
+
+        if self.batch_time > 0:
+            it = self._batch_iter(input_iter)
         else:
-            try:
-                while numtests:
-                    stop = False
-                    results = self.done_queue.get()
-                    for result in results:
-                        yield result
-                        if self.stop:
-                            if (result.status == 'FAIL' and not result.expected_fail) or (
-                                  result.status == 'OK' and result.expected_fail):
-                                stop = True
-                                break
-                    if stop:
+            it = ([tests] for tests in input_iter)
+
+        self._source = it
+        self._pending = OrderedDict()  # pending batches keyed by the modules they need
+        self._num_pending = 0
+
+        if self._wake_recv is not None:
+            self.slot_budget.add_listener(self._wake)
+
+        for w in self.workers:
+            self._dispatch(w)
+
+        stop = False
+        # with a shared budget, nothing may be running because the other runner is
+        # using all of the slots
+        while self._busy() or (self._wake_recv is not None and self._pending):
+            msg = self._next_message()
+            if msg is None:
+                # slots were freed
+                for idle in self.workers:
+                    if not idle.inflight and not self._dispatch(idle):
                         break
-                    numtests -= 1
-                    self.task_queue.put(next(it))
-                    numtests += 1
-            except StopIteration:
-                pass
+                continue
+            wid, results, last = msg
+            w = self.workers[wid]
+            unrun = w.finished(results, last)
+            reruns = []
+            for result in results:
+                again = self.reruns.rerun(result)
+                if again is not None:
+                    reruns.append(again)
+                    continue
+                yield self.reruns.finish(result)
+                if self.stop and _is_failure(result):
+                    stop = True
+            if unrun and not stop:
+                # with -x the worker ends its batch at the first failure, but a failure
+                # that is rerun doesn't stop the run, so the rest of the batch still
+                # has to be run
+                self._requeue(unrun)
+            for again in reversed(reruns):
+                # run it again as soon as a worker is free rather than at the end
+                self._requeue([[again]])
+            if stop:
+                break
+            if last and (not w.proc.is_alive() or self._should_retire(w)):
+                w = self._replace(w)
+            if last or reruns:
+                # the batch may have released core slots that other idle workers
+                # were waiting for
+                for idle in [w] + self.workers:
+                    if not idle.inflight and not self._dispatch(idle):
+                        break
+
+        if stop:
+            # reruns that won't happen now still have to report their failures
+            for batch in (b for batches in self._pending.values() for b in batches):
+                for tests in batch:
+                    for test in tests:
+                        failed = self.reruns.abandon(test)
+                        if failed is not None:
+                            yield failed
 
-        for proc in self.procs:
-            self.task_queue.put('STOP')
+            if self.options.fast_abort:
+                for result in self._abort():
+                    yield result
 
-        for i in range(numtests):
-            results = self.done_queue.get()
+        for w in self.workers:
+            w.task_queue.put('STOP')
+
+        while self._busy():
+            msg = self._next_message()
+            if msg is None:
+                continue
+            wid, results, last = msg
+            self.workers[wid].finished(results, last)
             for result in results:
-                yield result
+                yield self.reruns.finish(result)
+
+        if self._wake_recv is not None:
+            self.slot_budget.remove_listener(self._wake)
+
+        for w in self.workers + self.retired:
+            w.proc.join()
+            w.cleanup()
+
+    def _wake(self):
+        # one wakeup at a time is enough, and keeps the pipe from filling up
+        if not self._woken:
+            self._woken = True
+            self._wake_send.send(None)
+
+    def _next_message(self):
+        """Return the next (worker index, results, last) message from the workers, or
+        None if core slots were freed by another runner sharing our slot budget.
+
+        If a worker dies while it has work in flight, the group it was running is
+        reported as failed.
+        """
+        while True:
+            busy = [w for w in self.workers if w.inflight]
+
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            if deadlines:
+                timeout = max(0., min(deadlines) - time.perf_counter())
+            else:
+                timeout = None
+
+            waitfor = [w.conn for w in busy] + [w.proc.sentinel for w in busy]
+            if self._wake_recv is not None:
+                waitfor.append(self._wake_recv)
+            ready = wait(waitfor, timeout=timeout)
+
+            woken = False
+            if self._wake_recv is not None and self._wake_recv in ready:
+                self._woken = False
+                while self._wake_recv.poll():
+                    self._wake_recv.recv()
+                woken = True
+
+            if not ready:
+                # a worker has hung in a way that its own watchdog couldn't handle
+                now = time.perf_counter()
+                for w in busy:
+                    if w.deadline is not None and w.deadline <= now:
+                        w.proc.kill()
+                        w.killed = True
+                        w.deadline = None
+                continue
+
+            for w in busy:
+                if w.conn in ready:
+                    try:
+                        msgs, last = w.conn.recv()
+                    except (EOFError, OSError):
+                        w.proc.join()
+                        return self._worker_died(w)
+                    return w.index, merge_results(w.unfinished(), msgs), last
+
+            for w in busy:
+                # make sure we don't miss results sent just before the worker died
+                if w.proc.sentinel in ready and not w.conn.poll():
+                    w.proc.join()
+                    return self._worker_died(w)
+
+            if woken:
+                return None
+
+    def _worker_died(self, w):
+        """Fail the tests that the given dead worker hadn't finished in the group it was
+        running and return them as the final message of the worker's batch.  The rest of
+        the batch is put back by the caller.
+        """
+        tests = w.unfinished()
+
+        msg = "Worker process %s while running this test." % exit_description(w.proc.exitcode)
+        spec, stacks = w.read_dump()
+        if not (stacks or w.killed):
+            spec = None  # it crashed rather than timing out
+        if spec is not None:
+            running = spec
+        else:
+            running = tests[0].spec if tests else None
+        now = time.perf_counter()
+        results = []
+        for i, test in enumerate(tests):
+            test.status = 'FAIL'
+            if test.spec == running:
+                # tests that never got to run keep a start_time of 0, so that their
+                # duration isn't recorded
+                test.start_time = w.started
+                test.end_time = now
+            if spec is None:
+                # the first test that didn't finish is the one that was running
+                test.err_msg = msg if i == 0 else (
+                    "Worker process %s while running test %s, so this test wasn't run." %
+                    (exit_description(w.proc.exitcode), tests[0].spec))
+            elif test.spec == spec:
+                test.err_msg = "Test timed out after %s seconds." % self.options.timeout
+                if stacks:
+                    test.err_msg += "\n\n" + stacks
+            else:
+                test.err_msg = ("Worker process was stopped because test %s timed out." %
+                                spec)
+            results.append(test)
+
+        return w.index, results, True
+
+    def _abort(self):
+        """Kill every worker that still has work in flight, along with any subprocesses
+        it started, and return its unfinished tests marked as aborted.
+        """
+        results = []
+        for w in self.workers:
+            if not w.inflight:
+                continue
+            kill_process_tree(w.proc.pid)
+            w.proc.join()
+            # don't let a batch stuck in the queue of a dead worker keep us from exiting
+            w.task_queue.cancel_join_thread()
+            for tests in [w.unfinished()] + list(w.inflight)[1:]:
+                for test in tests:
+                    failed = self.reruns.abandon(test)
+                    if failed is not None:
+                        results.append(failed)
+                        continue
+                    test.status = ABORT
+                    test.err_msg = ABORT_MSG
+                    results.append(test)
+            w.inflight.clear()
+            self.slot_budget.release(w.slots)
+            w.slots = 0
+            w.deadline = None
+        return results
+
+    def _requeue(self, batch):
+        """Put a batch back at the front of the pending batches."""
+        key = () if self.ordered else tuple(sorted(_batch_modules(batch)))
+        if key in self._pending:
+            self._pending[key].appendleft(batch)
+        else:
+            self._pending[key] = deque([batch])
+        self._pending.move_to_end(key, last=False)
+        self._num_pending += 1
+
+    def _should_retire(self, w):
+        """Return True if the given idle worker should be replaced by a new one."""
+        max_tests = self.options.max_tests_per_worker
+        max_rss = self.options.max_worker_rss
+        return (max_tests > 0 and w.num_tests >= max_tests) or (0 < max_rss < w.rss)
+
+    def _replace(self, w):
+        """Stop the given idle (or dead) worker and start a new one in its place."""
+        w.task_queue.put('STOP')
+        self.retired.append(w)
+
+        new = _WorkerProc(w.index, self.options, self.context, self.slot_budget)
+        new.start()
+        self.workers[w.index] = new
+        return new
+
+    def _busy(self):
+        """Return True if any worker has a batch in flight."""
+        return any(w.inflight for w in self.workers)
+
+    def _read_ahead(self):
+        """Read batches from the source until we have batches from enough different
+        modules to give every worker a choice, or until we have something to run and
+        have spent read_ahead_time seconds reading.
+        """
+        if self._source is None:
+            return
+
+        deadline = time.perf_counter() + self.read_ahead_time
+        for batch in self._source:
+            if self.ordered:
+                key = ()  # keep the longest first or failed first order
+            else:
+                key = tuple(sorted(_batch_modules(batch)))
+            if key in self._pending:
+                self._pending[key].append(batch)
+            else:
+                self._pending[key] = deque([batch])
+            self._num_pending += 1
+            if (len(self._pending) > self.num_procs or
+                    self._num_pending >= self.max_pending or
+                    time.perf_counter() >= deadline):
+                break
+        else:
+            self._source = None
+
+    def _dispatch(self, w):
+        """Send the next batch to the given idle worker, preferring batches from
+        modules it has already imported.
+
+        Returns True if a batch was sent.
+        """
+        self._read_ahead()
+
+        if not self._pending:
+            return False
+
+        free = self.slot_budget.free()
+
+        # if the oldest pending batch doesn't fit, hold everything else back until it
+        # does so that a large MPI test can't be starved by a stream of small tests.
+        oldest = next(iter(self._pending.values()))[0]
+        if self._batch_slots(oldest) > free:
+            return False
+
+        key = self._pick(w, free)
+        batches = self._pending[key]
+        slots = self._batch_slots(batches[0])
+        if not self.slot_budget.take(slots):
+            return False  # another runner took them first
+        batch = batches.popleft()
+        if not batches:
+            del self._pending[key]
+        self._num_pending -= 1
+
+        w.send(batch, slots)
+        return True
 
-        for proc in self.procs:
-            proc.join()
+    def _batch_slots(self, batch):
+        """Return the number of core slots needed to run the given batch."""
+        slots = 1
+        for tests in batch:
+            for test in tests:
+                # only a test that is actually run under MPI starts N_PROCS ranks
+                if test.subproc_kind() == 'mpi':
+                    slots = max(slots, test.nprocs)
+        # a test that needs more than all of the slots still has to run at some point
+        return min(slots, self.core_slots)
+
+    def _pick(self, w, free):
+        """Return the key of the pending batches that the given worker should run next.
+
+        In order of preference, this is the first batch from a module that the worker
+        has already imported, then from a package that the worker has imported modules
+        from, then from a module that no other worker has imported. Otherwise the
+        worker just takes the oldest pending batch.  Batches needing more than the
+        given number of free core slots are skipped.
+        """
+        others = set()
+        for other in self.workers:
+            if other is not w:
+                others.update(other.modules)
+
+        best = None
+        best_score = -1
+        for key, batches in self._pending.items():
+            if self._batch_slots(batches[0]) > free:
+                continue
+            score = 0
+            for modpath in key:
+                if modpath in w.modules:
+                    return key
+                pkg = modpath.rpartition('.')[0]
+                if pkg and pkg in w.packages:
+                    score = max(score, 2)
+                elif modpath not in others:
+                    score = max(score, 1)
+            if score > best_score:
+                best = key
+                best_score = score
+
+        return best
+
+    def _batch_iter(self, input_iter):
+        """Combine groups of tests that are known to be short into batches that are
+        expected to take about batch_time seconds to run.
+        """
+        batch = []
+        batch_cost = 0.
+        for tests in input_iter:
+            if all(t.spec in self.durations for t in tests):
+                cost = self._group_cost(tests)
+                if cost < self.batch_time:
+                    batch.append(tests)
+                    batch_cost += cost
+                    if batch_cost >= self.batch_time:
+                        yield batch
+                        batch = []
+                        batch_cost = 0.
+                    continue
+
+            yield [tests]
+
+        if batch:
+            yield batch
+
+    def _group_cost(self, tests):
+        """Return the expected time to run the given group of tests."""
+        return sum(self.durations.estimate(t.spec) for t in tests if t.status is None)
+
+
+def _batch_modules(batch):
+    """Return the set of module paths that a worker has to import to run the given batch."""
+    mods = set()
+    for tests in batch:
+        for test in tests:
+            # tests that are run in a subprocess or have already failed don't import
+            # anything in the worker
+            if test.status is None and test.modpath and not _runs_in_subproc(test):
+                mods.add(test.modpath)
+    return mods
+
+
+class _WorkerProc(object):
+    """
+    Keeps track of a worker process and the work it has been given.
+
+    Attributes
+    ----------
+    index : int
+        Index of the worker.
+    proc : Process
+        The worker process.
+    task_queue : Queue
+        Queue used to send batches of test groups to this worker.
+    conn : Connection
+        Connection used to receive results from this worker.
+    inflight : deque
+        Test groups sent to the worker that haven't been reported back yet.
+    ndone : int
+        Number of tests in the first in-flight group that have been reported back.
+    modules : set
+        Module paths of the test modules that this worker has imported.
+    packages : set
+        Packages containing the test modules that this worker has imported.
+    num_tests : int
+        Number of tests that have been sent to this worker.
+    rss : float
+        Resident memory of the worker in MB after its most recent test group.
+    started : float
+        Time when the worker was last sent a batch or reported a result, which is
+        about when the test it's running started.
+    deadline : float or None
+        Time by which the worker must finish its current test group before it's
+        killed. This is only a backstop for the watchdog inside the worker.
+    killed : bool
+        True if the worker was killed for missing its deadline.
+    slots : int
+        Number of core slots used by the worker's in-flight batch.
+    slot_budget : SlotBudget
+        Core slots shared by all of the workers, which the slots are taken from.
+    """
+
+    def __init__(self, index, options, context, slot_budget):
+        self.index = index
+        self.task_queue = context.Queue()
+        self.conn, self._child_conn = context.Pipe(duplex=False)
+        self.inflight = deque()
+        self.ndone = 0
+        self.modules = set()
+        self.packages = set()
+        self.num_tests = 0
+        self.rss = 0.
+        self.started = 0.
+        self.deadline = None
+        self.killed = False
+        self.slots = 0
+        self.slot_budget = slot_budget
+        self.timeout = options.timeout
+
+        if self.timeout:
+            fd, self.dump_file = tempfile.mkstemp(prefix='testflo_worker_', suffix='.txt')
+            os.close(fd)
+        else:
+            self.dump_file = None
+
+        self.proc = context.Process(target=worker,
+                                    args=(self.task_queue, self._child_conn, index, options,
+                                          self.dump_file))
+
+    def start(self):
+        """Start the worker process."""
+        self.proc.start()
+        self._child_conn.close()
+
+    def send(self, batch, slots):
+        """Send a batch of test groups to the worker, along with the number of core
+        slots, already taken from the slot budget, that it needs.
+        """
+        self.task_queue.put(batch)
+        self.inflight.extend(batch)
+        self.slots = slots
+        self.started = time.perf_counter()
+        self._set_deadline()
+        self.num_tests += sum(1 for tests in batch for test in tests)
+        for modpath in _batch_modules(batch):
+            self.modules.add(modpath)
+            pkg = modpath.rpartition('.')[0]
+            if pkg:
+                self.packages.add(pkg)
+
+    def finished(self, results, last):
+        """Update our state after the worker reports the results of a group.
+
+        Returns a list of the groups in the worker's batch that it didn't run because
+        it ended the batch early.
+        """
+        self.started = time.perf_counter()
+        for result in results:
+            for r in result:
+                self.rss = r.worker_rss
+        unrun = []
+        if last:
+            # the worker may stop early, so the whole batch is done
+            unrun = list(self.inflight)[1:]
+            self.inflight.clear()
+            self.ndone = 0
+            self.slot_budget.release(self.slots)
+            self.slots = 0
+        else:
+            self.ndone += len(results)
+            if self.ndone >= sum(1 for test in self.inflight[0]):
+                self.inflight.popleft()
+                self.ndone = 0
+        self._set_deadline()
+        return unrun
+
+    def unfinished(self):
+        """Return a list of the tests in the first in-flight group that haven't been
+        reported back yet.
+        """
+        return list(self.inflight[0])[self.ndone:] if self.inflight else []
+
+    def _set_deadline(self):
+        """Set the time by which the worker's current test group must be done."""
+        if self.timeout and self.inflight:
+            ntests = len(self.unfinished())
+            self.deadline = (time.perf_counter() + self.timeout * ntests +
+                             max(self.timeout, 10.))
+        else:
+            self.deadline = None
+
+    def read_dump(self):
+        """Return (spec, stacks) for the test that was running when the worker's watchdog
+        fired, or (None, None) if it didn't fire.
+        """
+        if self.dump_file:
+            try:
+                with open(self.dump_file) as f:
+                    spec, _, stacks = f.read().partition('\n')
+            except OSError:
+                pass
+            else:
+                if spec:
+                    return spec, stacks.strip()
+        return None, None
+
+    def cleanup(self):
+        """Remove any files belonging to this worker."""
+        if self.dump_file:
+            try:
+                os.remove(self.dump_file)
+            except OSError:
+                pass
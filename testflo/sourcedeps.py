@@ -0,0 +1,223 @@
+"""
+Recording of the source files that a test depends on, for the result cache.
+
+On python 3.12 and later, sys.monitoring is used to record the file of every
+python function (or module) that starts running during the test.  If no other
+monitoring tool (e.g., coverage) is active, each code object is only reported once
+per test, so the overhead is small.  On older versions, the files of all modules
+that are loaded when the test finishes are recorded instead, which is a superset of
+what the test actually used.
+
+Either way, the modules that the test module refers to at module level are recorded
+too, along with the modules they refer to, and so on, so that a module whose
+constants a test uses is recorded even if none of its code runs during the test.
+So are any modules imported during the test.
+
+Files from the standard library and from testflo itself are never recorded.  Known
+holes are data files that a test reads, and constants of a module that a function
+imports after an earlier test in the same process already loaded it.  That's why
+the result cache is off unless asked for.
+"""
+
+import os
+import sys
+import sysconfig
+from types import ModuleType
+
+
+# sys.monitoring tool ids that aren't reserved for debuggers, coverage, profilers
+# or optimizers
+_TOOL_IDS = (3, 4)
+
+_testflo_dir = os.path.dirname(os.path.realpath(__file__)) + os.sep
+_stdlib_dirs = tuple(set(os.path.realpath(sysconfig.get_path(p)) + os.sep
+                         for p in ('stdlib', 'platstdlib')))
+_site_dirs = tuple(set(os.path.realpath(sysconfig.get_path(p)) + os.sep
+                       for p in ('purelib', 'platlib')))
+
+_realpaths = {}
+
+# files of the modules reachable at module level from each module, keyed by
+# (module name, skip_site)
+_closures = {}
+
+
+def _is_site_file(path):
+    """Return True if the given real path is in site-packages."""
+    return path.startswith(_site_dirs)
+
+
+def _source_file(fname):
+    """Return the real path of the given file if it should be recorded, else None."""
+    try:
+        return _realpaths[fname]
+    except KeyError:
+        pass
+
+    path = None
+    if fname and not fname.startswith('<'):
+        real = os.path.realpath(fname)
+        if (not real.startswith(_testflo_dir) and
+                (real.startswith(_site_dirs) or not real.startswith(_stdlib_dirs)) and
+                os.path.isfile(real)):
+            path = sys.intern(real)
+
+    _realpaths[fname] = path
+    return path
+
+
+class SourceRecorder(object):
+    """
+    Records the source files used while a test runs.
+
+    Attributes
+    ----------
+    files : set
+        Names of the files seen so far, as reported by the interpreter.
+    """
+
+    def __init__(self):
+        self.files = set()
+        self._tool = None
+        self._modules = None
+
+    def start(self):
+        """Start recording."""
+        self.files = set()
+        self._modules = set(sys.modules)
+        monitoring = getattr(sys, 'monitoring', None)
+        if monitoring is None:
+            return
+
+        for tool in _TOOL_IDS:
+            try:
+                monitoring.use_tool_id(tool, 'testflo')
+            except ValueError:
+                continue  # already in use
+            self._tool = tool
+
+            # restart_events() would re-enable code that every other tool has disabled
+            # too, which can slow coverage down a lot, so only report each code object
+            # once if we're the only tool.
+            alone = all(monitoring.get_tool(i) is None for i in range(6) if i != tool)
+            callback = self._py_start_once if alone else self._py_start
+            monitoring.register_callback(tool, monitoring.events.PY_START, callback)
+            monitoring.set_events(tool, monitoring.events.PY_START)
+            if alone:
+                # code disabled by the previous test has to report again for this one
+                monitoring.restart_events()
+            break
+
+    def add_module(self, mod):
+        """Record the given test module and the modules it refers to at module level,
+        transitively.
+
+        The test module may have been imported before recording started, e.g., by an
+        earlier test, so its own imports wouldn't be seen otherwise.
+        """
+        self.files.update(_module_closure(mod))
+
+    def _py_start(self, code, offset):
+        self.files.add(code.co_filename)
+
+    def _py_start_once(self, code, offset):
+        self.files.add(code.co_filename)
+        return sys.monitoring.DISABLE
+
+    def stop(self):
+        """Stop recording and return a sorted tuple of the real paths of the source
+        files that were used.
+        """
+        if self._tool is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool, 0)
+            monitoring.register_callback(self._tool, monitoring.events.PY_START, None)
+            monitoring.free_tool_id(self._tool)
+            self._tool = None
+            # modules imported during the test that have no python code to report,
+            # e.g., extension modules
+            for name in set(sys.modules) - self._modules:
+                fname = getattr(sys.modules.get(name), '__file__', None)
+                if isinstance(fname, str):
+                    self.files.add(fname)
+        else:
+            for mod in list(sys.modules.values()):
+                fname = getattr(mod, '__file__', None)
+                if isinstance(fname, str):
+                    self.files.add(fname)
+
+        paths = set()
+        for fname in self.files:
+            path = _source_file(fname)
+            if path is not None:
+                paths.add(path)
+        return tuple(sorted(paths))
+
+
+def _referenced_modules(mod):
+    """Return the modules that the given module refers to at module level, either
+    directly or through the classes and functions it imported from them.
+    """
+    mods = []
+    for obj in list(vars(mod).values()):
+        try:
+            if not isinstance(obj, ModuleType):
+                obj = sys.modules.get(getattr(obj, '__module__', None))
+        except Exception:
+            continue
+        if isinstance(obj, ModuleType):
+            mods.append(obj)
+    return mods
+
+
+def _module_closure(mod, skip_site=False):
+    """Return the files of the given module and of every module reachable from it at
+    module level, skipping the standard library and testflo, and site-packages too
+    if skip_site is True.
+    """
+    key = (mod.__name__, skip_site)
+    files = _closures.get(key)
+    if files is not None:
+        return files
+
+    files = set()
+    seen = {mod.__name__}
+    stack = [mod]
+    while stack:
+        m = stack.pop()
+        fname = getattr(m, '__file__', None)
+        path = _source_file(fname) if isinstance(fname, str) else None
+        if path is None or (skip_site and _is_site_file(path)):
+            continue  # don't look inside the standard library
+        files.add(fname)
+        for ref in _referenced_modules(m):
+            name = getattr(ref, '__name__', None)
+            if isinstance(name, str) and name not in seen:
+                seen.add(name)
+                stack.append(ref)
+
+    # only the test module itself is looked up again, so don't cache the others
+    _closures[key] = files = frozenset(files)
+    return files
+
+
+def imported_files(mod, before):
+    """Return a set of the real paths of the files that the given just imported module
+    depends on, i.e., those of the modules it refers to at module level (transitively)
+    and of any other modules that were imported along with it, given the names of the
+    modules that were imported before it.  The module's own file, the standard
+    library, site-packages and testflo are left out.
+    """
+    fnames = set(_module_closure(mod, skip_site=True))
+    for name in set(sys.modules) - before:
+        fname = getattr(sys.modules.get(name), '__file__', None)
+        if isinstance(fname, str):
+            fnames.add(fname)
+
+    paths = set()
+    for fname in fnames:
+        path = _source_file(fname)
+        if path is not None and not _is_site_file(path):
+            paths.add(path)
+    paths.discard(_source_file(getattr(mod, '__file__', None) or ''))
+    return paths
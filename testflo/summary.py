@@ -20,9 +20,12 @@ class ResultSummary(object):
 
     def get_iter(self, input_iter):
         oks = 0
+        cached = 0
         total = 0
         fails = []
         skips = []
+        flaky = []
+        aborted = 0
         test_sum_time = 0.
 
         write = self.stream.write
@@ -31,6 +34,9 @@ class ResultSummary(object):
             for test in tests:
                 total += 1
 
+                if test.cached:
+                    cached += 1
+
                 if test.status == 'OK':
                     if test.expected_fail:
                         fails.append(self.get_test_name(test))
@@ -43,8 +49,14 @@ class ResultSummary(object):
                     else:
                         fails.append(self.get_test_name(test))
                     test_sum_time += (test.end_time-test.start_time)
+                elif test.status == 'FLAKY':
+                    oks += 1
+                    flaky.append(self.get_test_name(test))
+                    test_sum_time += (test.end_time-test.start_time)
                 elif test.status == 'SKIP':
                     skips.append(self.get_test_name(test))
+                elif test.status == 'ABORT':
+                    aborted += 1
 
                 yield test
 
@@ -54,6 +66,11 @@ class ResultSummary(object):
             for s in sorted(skips):
                 print(s, file=self.stream)
 
+        if flaky:
+            write("\n\nThe following tests failed, then passed on a rerun:\n")
+            for f in sorted(flaky):
+                print(f, file=self.stream)
+
         if fails:
             write("\n\nThe following tests failed:\n")
             for f in sorted(fails):
@@ -63,11 +80,19 @@ class ResultSummary(object):
 
         write("\n\nPassed:  %d\nFailed:  %d\nSkipped: %d\n" %
                             (oks, len(fails), len(skips)))
+        if flaky:
+            write("Flaky:   %d (passed on a rerun)\n" % len(flaky))
+        if aborted:
+            write("Aborted: %d (killed after the first failure)\n" % aborted)
+        if cached:
+            write("Cached:  %d (passed in an earlier run and not rerun)\n" % cached)
 
         wallclock = time.perf_counter() - self._start_time
 
         s = "" if total == 1 else "s"
-        if self.options.isolated:
+        if self.options.serve:
+            procstr = " using remote agents"
+        elif self.options.isolated:
             procstr = " in isolated processes"
         else:
             procstr = " using %d processes" % self.options.num_procs
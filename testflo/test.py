@@ -9,6 +9,7 @@ import traceback
 from inspect import isclass
 import subprocess
 from contextlib import contextmanager, nullcontext
+from importlib.util import find_spec
 
 from types import FunctionType
 from io import StringIO
@@ -20,6 +21,9 @@ from testflo.util import get_module, ismethod, get_memory_usage, \
                          get_testpath, _options2args, _testing_path
 from testflo.utresult import UnitTestResult
 from testflo.devnull import DevNull
+from testflo.zygote import get_zygote, zygote_available
+from testflo.qman import get_result_file, get_result, remove_result_file
+from testflo.sourcedeps import SourceRecorder
 
 
 mpirun_exe = None
@@ -29,13 +33,20 @@ elif shutil.which("mpiexec") is not None:
     mpirun_exe = "mpiexec"
 
 
-def add_queue_to_env(queue):
-    """Store enough info in the env to be able to create a proxy to
-    the queue in a subprocess.
+_mpi_ok = None
+
+
+def _have_mpi():
+    """Return True if mpi4py's MPI module is available, in which case MPI tests are run
+    using mpirun.  MPI itself isn't imported, so it isn't initialized in this process.
     """
-    addr = queue._token.address
-    os.environ['TESTFLO_QUEUE'] = "%s:%s:%s" % (addr[0], addr[1],
-                                                queue._token.id)
+    global _mpi_ok
+    if _mpi_ok is None:
+        try:
+            _mpi_ok = find_spec('mpi4py.MPI') is not None
+        except ImportError:
+            _mpi_ok = False
+    return _mpi_ok
 
 
 class FakeComm(object):
@@ -45,7 +56,10 @@ class FakeComm(object):
 
 
 @contextmanager
-def testcontext(test, cov):
+def testcontext(test, cov, recorder=None):
+    if recorder is not None:
+        recorder.start()
+
     if cov is not None:
         cov.start()
         if test.options.dyn_contexts:
@@ -67,6 +81,8 @@ def testcontext(test, cov):
     finally:
         if cov is not None:
             cov.stop()
+        if recorder is not None:
+            test.deps = recorder.stop()
         sys.path = old_sys_path
         if 'TESTFLO_SPEC' in os.environ:
             del os.environ['TESTFLO_SPEC']
@@ -78,18 +94,24 @@ class Test(object):
     start/end times and resource usage data.
     """
 
-    def __init__(self, testspec, options):
+    # there can be a very large number of these, so avoid a __dict__ per instance
+    __slots__ = ('spec', 'options', 'status', 'err_msg', 'mpi', 'memory_usage', 'worker_rss',
+                 'nprocs', 'isolated', 'start_time', 'end_time', 'modpath', 'tcasename',
+                 'funcname', 'load', 'expected_fail', '_mod_fixture_first',
+                 '_mod_fixture_last', '_tcase_fixture_first', '_tcase_fixture_last', '_own_fixtures',
+                 'deprecations', 'deps', 'cached', 'worker_id')
+
+    def __init__(self, testspec, options, info=None):
         self.spec = testspec
         self.options = options
 
-        testpath, rest = get_testpath(testspec)
-        self.test_dir = os.path.dirname(testpath)
-
         self.status = None
         self.err_msg = ''
         self.mpi = False
 
         self.memory_usage = 0
+        self.worker_rss = 0
+        self.worker_id = None
         self.nprocs = 0
         self.isolated = False
         self.start_time = 0
@@ -103,10 +125,39 @@ class Test(object):
         self._mod_fixture_last = False
         self._tcase_fixture_first = False
         self._tcase_fixture_last = False
+        # True if the test runs its fixtures no matter which process it runs in
+        self._own_fixtures = False
+
+        # most tests have no deprecations, so don't create a dict until we find one
+        self.deprecations = None
 
-        self.deprecations = {}
+        # source files used by the test, if recorded for the result cache
+        self.deps = None
+        # True if the result came from the result cache rather than running the test
+        self.cached = False
 
-        self._get_test_info()
+        if info is None:
+            self._get_test_info()
+        else:
+            # info came from discovery, so we don't need to import the test module
+            modpath, tcasename, self.funcname, self.nprocs, self.isolated = info
+            # share the same strings between all tests from the same module and TestCase
+            self.modpath = sys.intern(modpath)
+            self.tcasename = None if tcasename is None else sys.intern(tcasename)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in Test.__slots__)
+
+    def __setstate__(self, state):
+        for name, val in zip(Test.__slots__, state):
+            setattr(self, name, val)
+        self.modpath = self.modpath if self.modpath is None else sys.intern(self.modpath)
+        self.tcasename = self.tcasename if self.tcasename is None else sys.intern(self.tcasename)
+
+    @property
+    def test_dir(self):
+        """The directory containing the test's module."""
+        return os.path.dirname(get_testpath(self.spec)[0])
 
     def __iter__(self):
         """Allows Test to be iterated over so we don't have to check later
@@ -114,14 +165,44 @@ class Test(object):
         """
         return iter((self,))
 
+    def run_own_fixtures(self):
+        """Make this test run its own module and TestCase fixtures, e.g., because it's
+        a rerun that runs without the rest of its fixture group.  This also applies
+        when it's run in a subprocess.
+        """
+        self._mod_fixture_first = self._mod_fixture_last = True
+        self._tcase_fixture_first = self._tcase_fixture_last = True
+        self._own_fixtures = True
+
+    def _info(self):
+        return (self.modpath, self.tcasename, self.funcname, self.nprocs, self.isolated)
+
+    def merge(self, msgs):
+        """Update this Test using the ResultMsgs from a run of this test in another
+        process, and return the result, which is either this Test or a list of
+        SubTests.
+        """
+        if len(msgs) == 1 and msgs[0].submsg is None:
+            msgs[0].apply(self)
+            return self
+
+        subs = []
+        for msg in msgs:
+            sub = SubTest(msg.submsg, self.spec, self.options, info=self._info())
+            msg.apply(sub)
+            subs.append(sub)
+        return subs
+
     def _get_test_info(self):
         """Get the test's module, testcase (if any), function name,
         N_PROCS (for mpi tests) and ISOLATED and set our attributes.
         """
         with testcontext(self, None):
             try:
-                mod, self.tcasename, self.funcname = _parse_test_path(self.spec)
-                self.modpath = mod.__name__
+                mod, tcasename, self.funcname = _parse_test_path(self.spec)
+                self.modpath = sys.intern(mod.__name__)
+                if tcasename is not None:
+                    self.tcasename = sys.intern(tcasename)
             except Exception:
                 self.status = 'FAIL'
                 self.err_msg = traceback.format_exc()
@@ -138,13 +219,34 @@ class Test(object):
         if self.err_msg:
             self.start_time = self.end_time = time.perf_counter()
 
-    def _run_subproc(self, cmd, queue, env):
+    def _subproc_env(self, env, result_file):
+        """Return the environment for a subprocess that writes its result to result_file."""
+        env = dict(env)
+        env['TESTFLO_RESULT_FILE'] = result_file
+        if self._own_fixtures:
+            env['TESTFLO_OWN_FIXTURES'] = '1'
+        return env
+
+    def _subproc_result(self, returncode, out, result_file):
+        """Return the result of a finished subprocess.
+
+        out is the captured stdout if nocapture is set, else the captured stderr.
+        """
+        if returncode != 0:
+            self.status = 'FAIL'
+            self.err_msg = out
+            return self
+
+        if self.options.nocapture:
+            print(out)
+        return self.merge(get_result(result_file))
+
+    def _run_subproc(self, cmd, env):
         """
         Run a command in a subprocess.
         """
+        result_file = get_result_file()
         try:
-            add_queue_to_env(queue)
-
             if self.options.nocapture:
                 stdout = subprocess.PIPE
                 stderr = subprocess.STDOUT
@@ -152,17 +254,13 @@ class Test(object):
                 stdout = subprocess.DEVNULL
                 stderr = subprocess.PIPE
 
-            p = subprocess.run(cmd, stdout=stdout, stderr=stderr, env=env,
+            p = subprocess.run(cmd, stdout=stdout, stderr=stderr,
+                               env=self._subproc_env(env, result_file),
                                timeout=self.options.timeout, universal_newlines=True)
 
-            if p.returncode != 0:
-                self.status = 'FAIL'
-                self.err_msg = p.stdout if self.options.nocapture else p.stderr
-                result = self
-            else:
-                if self.options.nocapture:
-                    print(p.stdout)
-                result = queue.get()
+            result = self._subproc_result(p.returncode,
+                                          p.stdout if self.options.nocapture else p.stderr,
+                                          result_file)
         except:
             # we generally shouldn't get here, but just in case,
             # handle it so that the main process doesn't hang at the
@@ -170,20 +268,46 @@ class Test(object):
             self.status = 'FAIL'
             self.err_msg = traceback.format_exc()
             result = self
+        finally:
+            remove_result_file(result_file)
 
         return result
 
-    def _run_isolated(self, queue):
+    def _isolated_cmd(self):
+        return [sys.executable,
+                os.path.join(os.path.dirname(__file__), 'isolatedrun.py'),
+                self.spec] + _options2args(self.options)
+
+    def _mpi_cmd(self):
+        if mpirun_exe is None:
+            raise Exception("mpirun or mpiexec was not found in the system path.")
+
+        return [mpirun_exe, '-n', str(self.nprocs),
+                sys.executable,
+                os.path.join(os.path.dirname(__file__), 'mpirun.py'),
+                self.spec] + _options2args(self.options)
+
+    def subproc_kind(self):
+        """Return 'mpi' or 'isolated' if run() would run this test in a subprocess,
+        else None.
+        """
+        if self.status is not None:
+            return None
+        if self.nprocs > 0 and not self.options.nompi:
+            return 'mpi' if _have_mpi() else None
+        elif self.options.isolated:
+            return 'isolated'
+        return None
+
+    def _run_isolated(self):
         """This runs the test in a subprocess,
         then returns the Test object.
         """
-
-        cmd = [sys.executable,
-               os.path.join(os.path.dirname(__file__), 'isolatedrun.py'),
-               self.spec]
-
         try:
-            result = self._run_subproc(cmd, queue, os.environ)
+            if self.options.zygote and zygote_available():
+                result = get_zygote(self.options).run(self)
+            else:
+                result = self._run_subproc(self._isolated_cmd(), os.environ)
         except:
             # we generally shouldn't get here, but just in case,
             # handle it so that the main process doesn't hang at the
@@ -197,21 +321,12 @@ class Test(object):
 
         return result
 
-    def _run_mpi(self, queue):
+    def _run_mpi(self):
         """This runs the test using mpirun in a subprocess,
         then returns the Test object.
         """
         try:
-            if mpirun_exe is None:
-                raise Exception("mpirun or mpiexec was not found in the system path.")
-
-            cmd =  [mpirun_exe, '-n', str(self.nprocs),
-                   sys.executable,
-                   os.path.join(os.path.dirname(__file__), 'mpirun.py'),
-                   self.spec] + _options2args(self.options)
-
-            result = self._run_subproc(cmd, queue, os.environ)
-
+            result = self._run_subproc(self._mpi_cmd(), os.environ)
         except:
             # we generally shouldn't get here, but just in case,
             # handle it so that the main process doesn't hang at the
@@ -225,27 +340,39 @@ class Test(object):
 
         return result
 
-    def run(self, queue=None, cov=None):
-        """Runs the test, assuming status is not already known."""
+    def run(self, cov=None, subprocs=True):
+        """Runs the test, assuming status is not already known.
+
+        If subprocs is False, the test is run in this process even if it's an MPI
+        or isolated test, e.g., because we're already running in a subprocess.
+        """
         if self.status is not None:
             # premature failure occurred (or dry run), just return
             return self
 
+        if subprocs:
+            kind = self.subproc_kind()
+            if kind == 'mpi':
+                return self._run_mpi()
+            elif kind == 'isolated':
+                return self._run_isolated()
+
         MPI = None
-        if self.nprocs > 0 and not self.options.nompi:
+        if self.nprocs > 0 and not self.options.nompi and _have_mpi():
             try:
                 from mpi4py import MPI
             except ImportError:
                 pass
-            else:
-                if queue is not None:
-                    return self._run_mpi(queue)
-        elif self.options.isolated:
-            return self._run_isolated(queue)
 
-        with testcontext(self, cov):
+        subs = []
+
+        recorder = SourceRecorder() if self.options.result_cache else None
+
+        with testcontext(self, cov, recorder):
             testpath, _ = get_testpath(self.spec)
             _, mod = get_module(testpath)
+            if recorder is not None:
+                recorder.add_module(mod)
 
             testcase = getattr(mod, self.tcasename) if self.tcasename is not None else None
             funcname, nprocs = (self.funcname, self.nprocs)
@@ -282,7 +409,6 @@ class Test(object):
 
             done = False
             expected = expected2 = expected3 = False
-            subs = []
 
             try:
                 old_err = sys.stderr
@@ -344,7 +470,8 @@ class Test(object):
                         if ut_subtests:
                             end_time = time.perf_counter()
                             for sub, err in ut_subtests:
-                                subtest = SubTest(sub._subDescription(), self.spec, self.options)
+                                subtest = SubTest(sub._subDescription(), self.spec,
+                                                  self.options, info=self._info())
                                 subtest.status = status
                                 subtest.err_msg = stream_val + err
                                 subtest.start_time = self.start_time
@@ -375,6 +502,8 @@ class Test(object):
                         deprecations = [wm for wm in w
                                         if wm.category is DeprecationWarning
                                         or wm.category is PendingDeprecationWarning]
+                        if deprecations and self.deprecations is None:
+                            self.deprecations = {}
                         for wm in deprecations:
                             msg = str(wm.message)
                             dep = self.deprecations.get(msg, set())
@@ -417,14 +546,68 @@ class SubTest(Test):
         String indicating which subtests were involved.
     """
 
-    def __init__(self, submsg, testspec, options):
-        super().__init__(testspec, options)
+    __slots__ = ('submsg',)
+
+    def __init__(self, submsg, testspec, options, info=None):
+        super().__init__(testspec, options, info)
         self.submsg = submsg
 
+    def __getstate__(self):
+        return super().__getstate__() + (self.submsg,)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-1])
+        self.submsg = state[-1]
+
     def __str__(self):
         return "%s: %s %s\n%s" % (self.spec, self.submsg, self.status, self.err_msg)
 
 
+class ResultMsg(object):
+    """
+    The outcome of running a test, sent back from the process that ran it.
+
+    The receiving process already has the Test, so only the attributes that running
+    it can change are sent rather than pickling the whole Test, options and all.
+
+    Attributes
+    ----------
+    submsg : str or None
+        Subtest description if this is the result of a subtest.
+    """
+
+    __slots__ = ('submsg', 'status', 'err_msg', 'start_time', 'end_time', 'memory_usage',
+                 'worker_rss', 'worker_id', 'load', 'expected_fail', 'deprecations', 'mpi',
+                 'isolated', 'deps')
+
+    _attrs = __slots__[1:]
+
+    def __init__(self, test):
+        self.submsg = getattr(test, 'submsg', None)
+        for name in self._attrs:
+            setattr(self, name, getattr(test, name))
+
+    def __getstate__(self):
+        # a tuple of values pickles smaller than a dict of slot names and values
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
+
+    def apply(self, test):
+        """Copy our results into the given Test."""
+        for name in self._attrs:
+            setattr(test, name, getattr(self, name))
+
+
+def result_messages(result):
+    """Return a tuple of ResultMsgs for the given result, which is either a Test or a
+    list of SubTests.
+    """
+    return tuple(ResultMsg(r) for r in result)
+
+
 def _parse_test_path(testspec):
     """Return a tuple of the form (module, testcase, func)
     based on the given testspec.
@@ -0,0 +1,68 @@
+"""
+Benchmarks for the memory used by testflo itself.  Run them using:
+
+    testflo --benchmark testflo/tests
+
+"""
+
+import os
+import gc
+import shutil
+import tempfile
+import tracemalloc
+
+from testflo.util import _get_parser
+from testflo.discover import TestDiscoverer
+
+
+NUM_TESTS = 100000
+TESTS_PER_CLASS = 100
+
+# fail if discovery holds on to more than this many bytes for each test found
+MAX_BYTES_PER_TEST = 500
+
+
+def _write_suite(dname, ntests, per_class):
+    with open(os.path.join(dname, 'test_generated.py'), 'w') as f:
+        f.write("import unittest\n")
+        for c in range(ntests // per_class):
+            f.write("\nclass TestGenerated%d(unittest.TestCase):\n" % c)
+            for i in range(per_class):
+                f.write("    def test_%d(self):\n        pass\n" % i)
+
+
+def discovered_bytes_per_test(ntests=NUM_TESTS, per_class=TESTS_PER_CLASS):
+    """Return the number of bytes allocated by discovery that are still in use
+    for each test found in a generated suite.
+    """
+    dname = tempfile.mkdtemp()
+    try:
+        _write_suite(dname, ntests, per_class)
+        options = _get_parser().parse_args(['--static-discovery', dname])
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            tests = [t for group in TestDiscoverer(options).get_iter([dname])
+                     for t in group]
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(dname)
+
+    assert len(tests) == ntests, "found %d tests instead of %d" % (len(tests), ntests)
+    return used / len(tests)
+
+
+def benchmark_discovery_memory():
+    per_test = discovered_bytes_per_test()
+    print("%.0f bytes per discovered test" % per_test)
+    assert per_test < MAX_BYTES_PER_TEST, \
+        "discovery used %.0f bytes per test, more than the limit of %d" % (
+            per_test, MAX_BYTES_PER_TEST)
+
+
+if __name__ == '__main__':
+    print("%.0f bytes per discovered test" % discovered_bytes_per_test())
@@ -0,0 +1,71 @@
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+import unittest
+
+
+# fails the first time it runs, and needs its setUpClass every time
+_flaky_test = """
+import os
+import unittest
+
+class TestFlaky(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.value = 1
+
+    def test_flaky(self):
+        marker = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ran_once')
+        first = not os.path.exists(marker)
+        open(marker, 'w').close()
+        self.assertEqual(self.value, 1)
+        self.assertFalse(first, "failing the first time")
+
+    def test_other(self):
+        pass
+"""
+
+
+class TestRerunsIsolated(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tempdir, 'test_flaky.py'), 'w') as f:
+            f.write(_flaky_test)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def _run_testflo(self, *args):
+        env = dict(os.environ)
+        topdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join([topdir, env.get('PYTHONPATH', '')])
+        p = subprocess.run([sys.executable, '-m', 'testflo', 'test_flaky.py', '--reruns', '2',
+                            '--reruns-isolated', '--noreport'] + list(args),
+                           cwd=self.tempdir, env=env, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT, universal_newlines=True)
+        return p.returncode, p.stdout
+
+    def _check_flaky(self, *args):
+        returncode, out = self._run_testflo(*args)
+        self.assertEqual(returncode, 0, out)
+        self.assertIn("Flaky:   1", out)
+        self.assertNotIn("AttributeError", out)
+
+    def test_rerun_isolated_serial(self):
+        self._check_flaky('-n', '1')
+
+    def test_rerun_isolated_concurrent(self):
+        self._check_flaky('-n', '2')
+
+    def test_rerun_isolated_zygote(self):
+        self._check_flaky('-n', '2', '--zygote')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,7 @@ from configparser import ConfigParser
 from fnmatch import fnmatch
 from os.path import join, dirname, basename, isfile,  abspath, split, splitext
 
-from argparse import ArgumentParser, _AppendAction
+from argparse import ArgumentParser, ArgumentTypeError, _AppendAction
 
 
 # create a copy of sys.path with an extra entry at the beginning so that
@@ -50,6 +50,71 @@ def _get_parser():
                         help='Number of concurrent test processes to run. By default, this will '
                              'use the number of virtual processors available.  To force tests to '
                              'run consecutively, specify a value of 1.')
+    parser.add_argument('--longest-first', action='store_true', dest='longest_first',
+                        help="Run the tests and test groups that took the longest in previous "
+                             "runs first. Test durations are recorded in the cache directory. "
+                             "Tests with no recorded duration are assumed to take the average "
+                             "time.")
+    parser.add_argument('--failed-first', action='store_true', dest='failed_first',
+                        help="Run the test groups that failed the last time they were run "
+                             "first, then groups from test files modified since the previous "
+                             "run, then everything else. Failures are read from the history "
+                             "database, and this run is recorded in it as with --history. "
+                             "Any tests listed in the --fail file are also treated as failed. "
+                             "All tests are discovered before any of them are run, so "
+                             "discovery doesn't overlap with running tests.")
+    parser.add_argument('--batch-time', type=float, action='store', dest='batch_time',
+                        metavar='SECONDS', default=0.,
+                        help="Send tests that took less than SECONDS in previous runs to the "
+                             "worker processes in batches that should take about SECONDS to "
+                             "run, to cut down on communication overhead for very short "
+                             "tests. Test durations are recorded in the cache directory.")
+    parser.add_argument('--core-slots', type=int, action='store', dest='core_slots',
+                        metavar='NUM', default=0,
+                        help="Maximum number of processes, counting each concurrent test "
+                             "process plus the ranks of any MPI tests it is running, that "
+                             "may be running tests at the same time. MPI tests wait until "
+                             "enough slots are free. Default is the number of concurrent "
+                             "test processes.")
+    parser.add_argument('--shard', type=parse_shard, action='store', dest='shard',
+                        metavar='INDEX/COUNT',
+                        help="Split the tests into COUNT shards and only run shard INDEX, "
+                             "where INDEX is from 1 to COUNT, e.g., 2/4. Test groups that "
+                             "share fixtures are kept together. Shards are balanced using "
+                             "the durations in --shard-durations if given, else by hashing "
+                             "test names.")
+    parser.add_argument('--shard-durations', action='store', dest='shard_durations',
+                        metavar='FILE',
+                        help="Durations file used to balance --shard, e.g., the "
+                             "durations.json from the cache directory of an earlier run of "
+                             "all of the tests with --longest-first or --batch-time, which "
+                             "are the runs that record durations. Every machine running a "
+                             "shard must use the same file. It is never updated by a "
+                             "sharded run.")
+    parser.add_argument('--serve', action='store', dest='serve', metavar='[HOST:]PORT',
+                        help="Instead of starting local test processes, wait for "
+                             "testflo-agent processes to connect on the given address and "
+                             "run the tests on them. If HOST isn't given, connections are "
+                             "accepted on all network interfaces (agents must always know "
+                             "the authentication key). The test files must be found at the "
+                             "same paths on every agent machine.")
+    parser.add_argument('--agent-wait', type=float, action='store', dest='agent_wait',
+                        metavar='SECONDS', default=600.,
+                        help="With --serve, if no agent has connected after this many "
+                             "seconds, report the remaining tests as failed instead of "
+                             "waiting. Use 0 to wait forever. Default is 600 seconds.")
+    parser.add_argument('--authkey', action='store', dest='authkey', metavar='KEY',
+                        help="Authentication key that agents must use when connecting to "
+                             "--serve. Defaults to the value of the TESTFLO_AUTHKEY "
+                             "environment variable, or a random key if that isn't set.")
+    parser.add_argument('--max-tests-per-worker', type=int, action='store',
+                        dest='max_tests_per_worker', metavar='NUM', default=0,
+                        help="Replace a worker process with a fresh one after it has run NUM "
+                             "tests.")
+    parser.add_argument('--max-worker-rss', type=float, action='store', dest='max_worker_rss',
+                        metavar='MB', default=0.,
+                        help="Replace a worker process with a fresh one when its resident "
+                             "memory exceeds MB megabytes after running a test group.")
     parser.add_argument('-o', '--outfile', action='store', dest='outfile',
                         metavar='FILE', default='testflo_report.out',
                         help='Name of test report file.  Default is testflo_report.out.')
@@ -61,6 +126,24 @@ def _get_parser():
     parser.add_argument('--dryrun', action='store_true', dest='dryrun',
                         help="Don't actually run tests, but print "
                           "which tests would have been run.")
+    parser.add_argument('--static-discovery', action='store_true', dest='static_discovery',
+                        help="Find tests by parsing test files instead of importing them. Files "
+                             "whose tests can't be determined without importing them are "
+                             "still imported.")
+    parser.add_argument('--discovery-procs', type=int, action='store', dest='discovery_procs',
+                        metavar='NUM', default=1,
+                        help="Number of processes used to import test modules during test "
+                             "discovery. Default is 1.")
+    parser.add_argument('--discovery-cache', action='store_true', dest='discovery_cache',
+                        help="Save the results of test discovery in the cache directory and "
+                             "reuse them for test files that haven't changed since the last run.")
+    parser.add_argument('--cache-hash', action='store_true', dest='cache_hash',
+                        help="When checking whether a cached test file has changed, compare "
+                             "file contents if its modification time or size has changed.")
+    parser.add_argument('--cache-dir', action='store', dest='cache_dir', metavar='DIR',
+                        default='.testflo_cache',
+                        help="Directory where testflo stores data between runs. Default is "
+                             ".testflo_cache.")
     parser.add_argument('--pre_announce', action='store_true', dest='pre_announce',
                         help="Announce the name of each test before it runs. This "
                              "can help track down a hanging test. This automatically sets -n 1.")
@@ -73,12 +156,50 @@ def _get_parser():
                         help="Display full test specs instead of shortened names.")
     parser.add_argument('-i', '--isolated', action='store_true', dest='isolated',
                         help="Run each test in a separate subprocess.")
+    parser.add_argument('--zygote', action='store_true', dest='zygote',
+                        help="When running tests in separate subprocesses, fork each one from "
+                             "a zygote process that has already imported any modules specified "
+                             "with --preload, instead of starting a new python interpreter for "
+                             "each test. Not supported on Windows.")
+    parser.add_argument('--preload', action='append', dest='preload', metavar='MODULE',
+                        default=[],
+                        help="Import the given module(s) once in a process that other test "
+                             "processes are forked from. This applies to the concurrent "
+                             "worker processes, so they start with the modules already "
+                             "imported and share that memory, and to --zygote. Multiple "
+                             "modules can be given as a comma separated list or by using "
+                             "this option multiple times.")
+    parser.add_argument('--async-subprocs', action='store_true', dest='async_subprocs',
+                        help="Start the subprocesses for isolated and MPI tests directly "
+                             "from the main testflo process using asyncio instead of from "
+                             "worker processes. The number of subprocess ranks running at "
+                             "once is limited by --core-slots.")
     parser.add_argument('--nompi', action='store_true', dest='nompi',
                         help="Force all tests to run without MPI. This can be useful "
                              "for debugging.")
     parser.add_argument('-x', '--stop', action='store_true', dest='stop',
                         help="Stop after the first test failure, or as soon as possible"
                              " when running concurrent tests.")
+    parser.add_argument('--fast-abort', action='store_true', dest='fast_abort',
+                        help="Like --stop, but when running concurrent tests, kill any tests "
+                             "that are still running after the first failure, including "
+                             "isolated and MPI subprocesses, and report them as aborted. "
+                             "Aborted tests don't count as skipped.")
+    parser.add_argument('--reruns', type=int, action='store', dest='reruns', metavar='N',
+                        default=0,
+                        help="Run each failed test again, up to N times, as soon as it fails. "
+                             "A test that passes on a rerun is reported as FLAKY, which "
+                             "doesn't fail the run. If there is a history database, tests "
+                             "that have been flaky in recent runs recorded in it are run "
+                             "first, after any failed tests if --failed-first is also given. "
+                             "This run is only recorded in the history database if --history "
+                             "or --failed-first is also given.")
+    parser.add_argument('--reruns-time', type=float, action='store', dest='reruns_time',
+                        metavar='SECONDS', default=0.,
+                        help="Stop starting reruns once they have taken this many seconds "
+                             "in total. Default is no limit.")
+    parser.add_argument('--reruns-isolated', action='store_true', dest='reruns_isolated',
+                        help="Run reruns of failed tests in separate subprocesses.")
     parser.add_argument('-s', '--nocapture', action='store_true', dest='nocapture',
                         help="Standard output (stdout) will not be captured and will be"
                              " written to the screen immediately.")
@@ -101,6 +222,39 @@ def _get_parser():
                         "current working directory.")
     parser.add_argument('--cover-contexts', action='store_true', dest='dyn_contexts',
                         help="Record which tests hit which lines (increases overhead)."),
+    parser.add_argument('--changed-since', action='store', dest='changed_since',
+                        metavar='REV',
+                        help="Only run tests that may be affected by files that differ from "
+                             "git revision REV, including uncommitted and untracked files. "
+                             "Which files each test depends on is recorded in the cache "
+                             "directory by running with --coverage --cover-contexts. Tests "
+                             "with no recorded dependencies, or whose own file changed, are "
+                             "always run.")
+    parser.add_argument('--changed', action='append', dest='changed', metavar='FILE',
+                        default=[],
+                        help="Like --changed-since, but with the changed files given "
+                             "explicitly. Multiple files can be given as a comma separated "
+                             "list or by using this option multiple times.")
+    parser.add_argument('--result-cache', action='store_true', dest='result_cache',
+                        help="Don't rerun tests that passed in an earlier run if their test "
+                             "file and the source files they used haven't changed since. "
+                             "They are reported as passed (cached). Results are kept in the "
+                             "cache directory.")
+    parser.add_argument('--force-rerun', action='store_true', dest='force_rerun',
+                        help="With --result-cache, run all tests anyway and update the cache "
+                             "with their results.")
+    parser.add_argument('--result-cache-size', type=int, action='store',
+                        dest='result_cache_size', metavar='NUM', default=10000,
+                        help="Maximum number of test results to keep in the result cache. "
+                             "The least recently used are dropped first. Default is 10000.")
+    parser.add_argument('--history', action='store_true', dest='history',
+                        help="Record the status, duration, memory usage, load, worker and "
+                             "run type of every test in a SQLite database in the cache "
+                             "directory. Use the testflo-history command to query it.")
+    parser.add_argument('--history-max-runs', type=int, action='store',
+                        dest='history_max_runs', metavar='NUM', default=100,
+                        help="Number of most recent runs to keep in the history database. "
+                             "Default is 100.")
     parser.add_argument('-b', '--benchmark', action='store_true', dest='benchmark',
                         help='Specifies that benchmarks are to be run rather '
                              'than tests, so only files starting with "benchmark_" '
@@ -153,7 +307,9 @@ def _get_parser():
     parser.add_argument('--timeout', action='store', dest='timeout', type=float, metavar='TIME_LIMIT',
                         help="Timeout in seconds. A test will be terminated if it takes longer than "
                              "'TIME_LIMIT'. Only works for tests running in a subprocess "
-                             "(MPI or isolated).")
+                             "(MPI or isolated) or in a concurrent worker process (-n > 1). "
+                             "A worker that times out dumps its python stacks into the "
+                             "test's error message and is replaced by a new worker.")
 
     return parser
 
@@ -162,11 +318,11 @@ def _options2args(options):
     """Gets the testflo args that should be passed to subprocesses."""
 
     store_args = set([
-      'coverage_dir',
+      'cover_dir',
     ])
 
     multi_args = set([
-      'coverpkg',
+      'coverpkgs',
       'cover_omits',
     ])
 
@@ -176,6 +332,7 @@ def _options2args(options):
       'nocapture',
       'cover_branch',
       'dyn_contexts',
+      'result_cache',
     ])
 
     all_args = store_args | store_true_args | multi_args
@@ -392,9 +549,9 @@ def try_import(fname, modpath):
     return mod
 
 
-def get_module(fname):
+def get_modpath(fname):
     """Given a filename or module path name, return a tuple
-    of the form (filename, module).
+    of the form (filename, module path) without importing the module.
     """
 
     if fname.endswith('.py'):
@@ -426,6 +583,14 @@ def get_module(fname):
             else:
                 raise ImportError("can't import %s" % modpath)
 
+    return fname, modpath
+
+
+def get_module(fname):
+    """Given a filename or module path name, return a tuple
+    of the form (filename, module).
+    """
+    fname, modpath = get_modpath(fname)
     mod = try_import(fname, modpath)
 
     return fname, mod
@@ -459,6 +624,38 @@ def _get_parser_action_map():
     return _parser_types
 
 
+def get_changed_files(rev):
+    """Return the set of real paths of the files in the current git repository that
+    differ from the given revision, including uncommitted and untracked files.
+    """
+    import subprocess
+
+    def git(*args, cwd=None):
+        try:
+            return subprocess.run(('git',) + args, cwd=cwd, check=True, capture_output=True,
+                                  universal_newlines=True).stdout
+        except (OSError, subprocess.CalledProcessError) as err:
+            msg = getattr(err, 'stderr', None) or str(err)
+            raise RuntimeError("Couldn't find the files changed since '%s': %s" %
+                               (rev, msg.strip()))
+
+    top = git('rev-parse', '--show-toplevel').strip()
+    names = git('diff', '--name-only', rev, '--', cwd=top).splitlines()
+    names += git('ls-files', '--others', '--exclude-standard', cwd=top).splitlines()
+    return set(os.path.realpath(join(top, n)) for n in names if n)
+
+
+def parse_shard(shard):
+    """Return an (index, count) tuple for a shard of the form INDEX/COUNT."""
+    try:
+        index, count = (int(s) for s in shard.split('/'))
+    except ValueError:
+        raise ArgumentTypeError("shard must be of the form INDEX/COUNT, e.g., 2/4")
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("shard index must be from 1 to %d" % count)
+    return index, count
+
+
 def read_config_file(cfgfile, options):
     config = ConfigParser()
     config.read_file(open(cfgfile), source=cfgfile)
@@ -507,6 +704,86 @@ def get_memory_usage():
             return 0.
 
 
+def signal_name(signum):
+    """return the name of the given signal number, e.g., SIGSEGV"""
+    import signal
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return str(signum)
+
+
+def exit_description(exitcode):
+    """return a description of how a process with the given exit code ended"""
+    if exitcode is not None and exitcode < 0:
+        return "was killed by signal %s" % signal_name(-exitcode)
+    return "exited with code %s" % exitcode
+
+
+def get_current_rss():
+    """return the current resident memory of the current process in MB"""
+    k = 1024.
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss/(k*k)
+    except ImportError:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')/(k*k)
+        except (OSError, ValueError, AttributeError):
+            # fall back to peak memory usage
+            return get_memory_usage()
+
+
+def _get_child_pids():
+    """Return a dict mapping the pids of running processes to lists of their children's
+    pids, using the /proc filesystem.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    stat = f.read()
+                ppid = int(stat.rpartition(')')[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue  # the process has already gone away
+            children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def kill_process_tree(pid):
+    """Kill the process with the given pid along with all of its descendants, e.g., the
+    subprocesses of isolated or MPI tests.
+
+    If psutil isn't installed and there is no /proc filesystem, only the given process
+    is killed.
+    """
+    import signal
+    try:
+        import psutil
+    except ImportError:
+        try:
+            children = _get_child_pids()
+        except OSError:
+            children = {}
+        pids = [pid]
+        for p in pids:
+            pids.extend(children.get(p, ()))
+    else:
+        try:
+            pids = [pid] + [p.pid for p in psutil.Process(pid).children(recursive=True)]
+        except psutil.NoSuchProcess:
+            return
+
+    # kill the parents first so they can't start anything new
+    for p in pids:
+        try:
+            os.kill(p, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        except OSError:
+            pass
+
+
 def elapsed_str(elapsed):
     """return a string of the form hh:mm:sec"""
     hrs = int(elapsed/3600)
@@ -0,0 +1,217 @@
+"""
+A zygote process for running isolated tests.
+
+Rather than starting a new python interpreter for every isolated test, a
+zygote process imports commonly used modules once and then forks a new child
+process for each test.  Each test still runs in its own process, but without
+paying for interpreter startup and the import of all of its dependencies.
+
+This only works on platforms that support os.fork.
+"""
+
+import os
+import sys
+import gc
+import pickle
+import signal
+import traceback
+from importlib import import_module
+from multiprocessing import Pipe
+
+from testflo.util import exit_description
+
+
+_zygote = None
+
+
+def zygote_available():
+    """Return True if isolated tests can be run from a zygote on this platform."""
+    return hasattr(os, 'fork') and sys.platform != 'win32'
+
+
+def get_zygote(options):
+    """Return the zygote for the current process, starting it if necessary."""
+    global _zygote
+    if _zygote is None or not _zygote.is_alive():
+        _zygote = Zygote(options)
+    return _zygote
+
+
+def start_zygote(options):
+    """Start the zygote for the current process if isolated tests will be run from one.
+
+    This should be called before the process starts any threads or imports any tests,
+    so that neither ends up in the forked zygote.
+    """
+    if options.zygote and (options.isolated or options.reruns_isolated) and \
+            zygote_available():
+        get_zygote(options)
+
+
+def stop_zygote():
+    """Shut down the zygote for the current process, if there is one."""
+    global _zygote
+    if _zygote is not None:
+        _zygote.shutdown()
+        _zygote = None
+
+
+def get_preloads(options):
+    """Return the list of module names to be preloaded."""
+    mods = []
+    for entry in options.preload:
+        mods.extend(m.strip() for m in entry.split(',') if m.strip())
+    return mods
+
+
+def preload(modules):
+    """Import the given modules, then move everything that survives a garbage
+    collection into the permanent generation so that forked children don't touch
+    (and therefore don't copy) those pages when they collect garbage.
+    """
+    for modname in modules:
+        try:
+            import_module(modname)
+        except ImportError:
+            print("testflo: couldn't preload module '%s'" % modname, file=sys.stderr)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+class Zygote(object):
+    """
+    Manages a zygote process that forks a child process to run each test.
+
+    Attributes
+    ----------
+    pid : int
+        Process id of the zygote process.
+    """
+
+    def __init__(self, options):
+        self._options = options
+        self._conn, child_conn = Pipe()
+
+        self.pid = os.fork()
+        if self.pid == 0:  # zygote process
+            self._conn.close()
+            try:
+                _zygote_loop(child_conn, options)
+            finally:
+                os._exit(0)
+
+        child_conn.close()
+
+    def is_alive(self):
+        try:
+            pid, _ = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            return False
+        return pid == 0
+
+    def run(self, test):
+        """Run the given test in a process forked from the zygote and return the
+        resulting Test object(s).
+        """
+        self._conn.send((test.spec, test._own_fixtures))
+        pid = self._conn.recv()
+
+        timeout = self._options.timeout
+        if not self._conn.poll(timeout):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            exitcode, data = self._conn.recv()
+            test.status = 'FAIL'
+            test.err_msg = "Test timed out after %s seconds." % timeout
+            return test
+
+        exitcode, data = self._conn.recv()
+
+        if data:
+            return test.merge(pickle.loads(data))
+
+        test.status = 'FAIL'
+        test.err_msg = "Test process %s." % exit_description(exitcode)
+        return test
+
+    def shutdown(self):
+        """Tell the zygote process to exit."""
+        try:
+            self._conn.send(None)
+            self._conn.close()
+            os.waitpid(self.pid, 0)
+        except (OSError, ChildProcessError):
+            pass
+
+
+def _zygote_loop(conn, options):
+    """Wait for test specs to arrive, then fork a child process to run each one."""
+    from testflo.test import Test, result_messages
+    from testflo.cover import setup_coverage
+
+    preload(get_preloads(options))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break  # our parent is gone
+
+        if msg is None:
+            break
+        spec, own_fixtures = msg
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # test process
+            conn.close()
+            os.close(rfd)
+            status = 0
+            test = None
+            try:
+                cov = setup_coverage(options)
+                try:
+                    test = Test(spec, options)
+                    if own_fixtures:
+                        test.run_own_fixtures()
+                    result = test.run(cov=cov, subprocs=False)
+                except:
+                    if test is None:
+                        raise
+                    test.status = 'FAIL'
+                    test.err_msg = traceback.format_exc()
+                    result = test
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    if cov is not None:
+                        cov.save()
+
+                data = pickle.dumps(result_messages(result), pickle.HIGHEST_PROTOCOL)
+                with os.fdopen(wfd, 'wb') as f:
+                    f.write(data)
+            except:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        os.close(wfd)
+        conn.send(pid)
+
+        chunks = []
+        with os.fdopen(rfd, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                chunks.append(chunk)
+
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            exitcode = -os.WTERMSIG(status)
+        else:
+            exitcode = os.WEXITSTATUS(status)
+
+        conn.send((exitcode, b''.join(chunks)))